@@ -6,6 +6,7 @@ import numpy as np
 import torch
 import math
 import re
+from functools import lru_cache
 
 from gradio import inputs
 from diffusers import (
@@ -21,9 +22,15 @@ from torchvision import transforms
 from transformers import CLIPTokenizer, CLIPTextModel
 from PIL import Image
 from pathlib import Path
-from safetensors.torch import load_file
 import modules.safe as _
+from modules.attention import release_workspaces
+from modules.embeddings import EmbeddingRegistry
+from modules.ingest import ingest, start_pool
 from modules.lora import LoRANetwork
+from modules.prompt_parser import conditioning_cache
+
+# workers for uploaded files are forked now, before cuda is initialized and the ui starts its threads
+start_pool()
 
 models = [
     ("AbyssOrangeMix2", "Korakoe/AbyssOrangeMix2-HF", 2),
@@ -97,6 +104,9 @@ pipe.setup_text_encoder(clip_skip, text_encoder)
 if torch.cuda.is_available():
     pipe = pipe.to("cuda")
 
+# default resolution and its default upscaled size
+pipe.tune_attention([(512, 512), (int(512 * 1.2), int(512 * 1.2))])
+
 def get_model_list():
     return models
 
@@ -112,10 +122,20 @@ lora_cache = {
     base_model: LoRANetwork(text_encoder, unet)
 }
 
-te_base_weight_length = text_encoder.get_input_embeddings().weight.data.shape[0]
+embedding_registry = EmbeddingRegistry(tokenizer)
 original_prepare_for_tokenization = tokenizer.prepare_for_tokenization
 current_model = base_model
 
+def lora_stack(lora_state, lora_scale):
+    """
+    (file, scale) pairs of the LoRAs to load: lora_state is a list of files, lora_scale either one scale for all of
+    them or a list of scales
+    """
+    lora_files = lora_state if isinstance(lora_state, list) else [lora_state]
+    lora_scales = lora_scale if isinstance(lora_scale, list) else [lora_scale] * len(lora_files)
+    return list(zip(lora_files, lora_scales))
+
+
 def setup_model(name, lora_state=None, lora_scale=1.0):
     global pipe, current_model
 
@@ -139,22 +159,21 @@ def setup_model(name, lora_state=None, lora_scale=1.0):
 
     local_te, local_unet, local_lora, = te_cache[model], unet_cache[model], lora_cache[model]
     local_unet.set_attn_processor(CrossAttnProcessor())
-    local_lora.reset()
     clip_skip = models[keys.index(name)][2]
 
     if torch.cuda.is_available():
         local_unet.to("cuda")
         local_te.to("cuda")
 
-    if lora_state is not None and lora_state != "":
-        local_lora.load(lora_state, lora_scale)
-        local_lora.to(local_unet.device, dtype=local_unet.dtype)
+    if lora_state is not None and len(lora_state) > 0:
+        local_lora.load_multiple(lora_stack(lora_state, lora_scale), local_unet.device, dtype=local_unet.dtype)
+        local_lora.merge()
+    else:
+        local_lora.reset()
 
     pipe.text_encoder, pipe.unet = local_te, local_unet
     pipe.setup_unet(local_unet)
     pipe.tokenizer.prepare_for_tokenization = original_prepare_for_tokenization
-    pipe.tokenizer.added_tokens_encoder = {}
-    pipe.tokenizer.added_tokens_decoder = {}
     pipe.setup_text_encoder(clip_skip, local_te)
     return pipe
 
@@ -167,28 +186,31 @@ def error_str(error, title="Error"):
         else ""
     )
 
-def make_token_names(embs):
-    all_tokens = []
-    for name, vec in embs.items():
-        tokens = [f'emb-{name}-{i}' for i in range(len(vec))]
-        all_tokens.append(tokens)
-    return all_tokens
-
-def setup_tokenizer(tokenizer, embs):
-    reg_match = [re.compile(fr"(?:^|(?<=\s|,)){k}(?=,|\s|$)") for k in embs.keys()]
-    clip_keywords = [' '.join(s) for s in make_token_names(embs)]
+@lru_cache(maxsize=64)
+def get_trigger_matcher(triggers):
+    """
+    Builds one regex matching every embedding name in triggers (a tuple of (name, replacement) pairs) as a whole word,
+    so that all of them are replaced in a single scan of the prompt. Cached per embedding set.
+    """
+    replacements = dict(triggers)
+    names = sorted(replacements.keys(), key=len, reverse=True)
+    reg_match = re.compile(fr"(?:^|(?<=\s|,))(?:{'|'.join(re.escape(k) for k in names)})(?=,|\s|$)")
+    return reg_match, replacements
+
+def setup_tokenizer(tokenizer, token_names):
+    reg_match, replacements = get_trigger_matcher(
+        tuple(sorted((k, ' '.join(v)) for k, v in token_names.items()))
+    )
 
     def parse_prompt(prompt: str):
-        for m, v in zip(reg_match, clip_keywords):
-            prompt = m.sub(v, prompt)
-        return prompt
+        return reg_match.sub(lambda m: replacements[m.group(0)], prompt)
 
     def prepare_for_tokenization(self, text: str, is_split_into_words: bool = False, **kwargs):
         text = parse_prompt(text)
         r = original_prepare_for_tokenization(text, is_split_into_words, **kwargs)
         return r
-        tokenizer.prepare_for_tokenization = prepare_for_tokenization.__get__(tokenizer, CLIPTokenizer)
-    return [t for sublist in make_token_names(embs) for t in sublist]
+
+    tokenizer.prepare_for_tokenization = prepare_for_tokenization.__get__(tokenizer, CLIPTokenizer)
 
 
 def convert_size(size_bytes):
@@ -235,25 +257,15 @@ def inference(
             sampler_name, sampler_opt = funcname, options
 
     tokenizer, text_encoder = pipe.tokenizer, pipe.text_encoder
+    token_names = {}
     if embs is not None and len(embs) > 0:
-        ti_embs = {}
-        for name, file in embs.items():
-            if str(file).endswith(".pt"):
-                loaded_learned_embeds = torch.load(file, map_location="cpu")
-            else:
-                loaded_learned_embeds = load_file(file, device="cpu")
-            loaded_learned_embeds = loaded_learned_embeds["string_to_param"]["*"] if "string_to_param" in loaded_learned_embeds else loaded_learned_embeds
-            ti_embs[name] = loaded_learned_embeds
-
-        if len(ti_embs) > 0:
-            tokens = setup_tokenizer(tokenizer, ti_embs)
-            added_tokens = tokenizer.add_tokens(tokens)
-            delta_weight = torch.cat([val for val in ti_embs.values()], dim=0)
-
-            assert added_tokens == delta_weight.shape[0]
-            text_encoder.resize_token_embeddings(len(tokenizer))
-            token_embeds = text_encoder.get_input_embeddings().weight.data
-            token_embeds[-delta_weight.shape[0]:] = delta_weight
+        token_names = embedding_registry.activate(text_encoder, embs)
+        setup_tokenizer(tokenizer, token_names)
+
+    pipe.prompt_parser.network_key = (
+        tuple(lora_stack(lora_state, lora_scale)) if lora_state else None,
+        tuple(sorted((name, tuple(tokens)) for name, tokens in token_names.items())),
+    )
 
     config = {
         "negative_prompt": neg_prompt,
@@ -268,29 +280,34 @@ def inference(
         "timeout": timeout,
     }
 
-    if img_input is not None:
-        ratio = min(height / img_input.height, width / img_input.width)
-        img_input = img_input.resize(
-            (int(img_input.width * ratio), int(img_input.height * ratio)), Image.LANCZOS
-        )
-        result = pipe.img2img(prompt, image=img_input, strength=i2i_scale, **config)
-    elif hr_enabled:
-        result = pipe.txt2img(
-            prompt,
-            width=width,
-            height=height,
-            upscale=True,
-            upscale_x=hr_scale,
-            upscale_denoising_strength=hr_denoise,
-            **config,
-            **latent_upscale_modes[hr_method],
-        )
-    else:
-        result = pipe.txt2img(prompt, width=width, height=height, **config)
+    try:
+        if img_input is not None:
+            ratio = min(height / img_input.height, width / img_input.width)
+            img_input = img_input.resize(
+                (int(img_input.width * ratio), int(img_input.height * ratio)), Image.LANCZOS
+            )
+            result = pipe.img2img(prompt, image=img_input, strength=i2i_scale, **config)
+        elif hr_enabled:
+            result = pipe.txt2img(
+                prompt,
+                width=width,
+                height=height,
+                upscale=True,
+                upscale_x=hr_scale,
+                upscale_denoising_strength=hr_denoise,
+                **config,
+                **latent_upscale_modes[hr_method],
+            )
+        else:
+            result = pipe.txt2img(prompt, width=width, height=height, **config)
+    finally:
+        release_workspaces()  # flash attention workspaces of this worker thread
 
     end_time = time.time()
     vram_free, vram_total = torch.cuda.mem_get_info()
-    print(f"done: model={model}, res={width}x{height}, step={steps}, time={round(end_time-start_time, 2)}s, vram_alloc={convert_size(vram_total-vram_free)}/{convert_size(vram_total)}")
+    cache_stats = conditioning_cache.stats()
+    print(f"done: model={model}, res={width}x{height}, step={steps}, time={round(end_time-start_time, 2)}s, vram_alloc={convert_size(vram_total-vram_free)}/{convert_size(vram_total)}, "
+          f"conditioning_cache={cache_stats['hits']} hits/{cache_stats['misses']} misses, {round(cache_stats['saved_time'], 2)}s saved")
     return gr.Image.update(result[0][0], label=f"Initial Seed: {seed}")
 
 
@@ -426,17 +443,22 @@ def add_net(files, ti_state, lora_state):
     if files is None:
         return ti_state, "", lora_state, None
 
-    for file in files:
-        item = Path(file.name)
-        stripedname = str(item.stem).strip()
-        if item.suffix == ".pt":
-            state_dict = torch.load(file.name, map_location="cpu")
-        else:
-            state_dict = load_file(file.name, device="cpu")
-        if any("lora" in k for k in state_dict.keys()):
-            lora_state = file.name
-        else:
-            ti_state[stripedname] = file.name
+    # files are classified in parallel; results are applied in upload order, which is the order LoRAs are stacked in
+    paths = [file.name for file in files]
+    kinds = {}
+    for path, kind, error in ingest(paths):
+        if error is not None:
+            print(f"Could not add {path}: {error}")
+        kinds[path] = kind
+
+    for path in paths:
+        if kinds.get(path) == "lora":
+            lora_state = list(lora_state or [])
+            if path not in lora_state:
+                lora_state.append(path)
+        elif kinds.get(path) == "embedding":
+            stripedname = str(Path(path).stem).strip()
+            ti_state[stripedname] = path
 
     return (
         ti_state,
@@ -0,0 +1,97 @@
+# Micro benchmarks for the inference hot paths.
+# usage: python benchmark.py [lora] [attention]
+
+import sys
+import time
+import torch
+
+from modules.attention import FlashAttentionFunction, flash_attention_inference
+from modules.lora import LoRAModule
+
+
+def timeit(fn, repeat=50, warmup=5):
+    for _ in range(warmup):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_lora(max_loras=8, rank=16, dim=640, tokens=4096):
+    """
+    cost of an attention projection of the U-Net (a dim x dim Linear over a 64x64 latent) versus the number of
+    active LoRAs, stacked on one module (a single pair of matmuls) and chained as one module per LoRA.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    x = torch.randn(2, tokens, dim, device=device, dtype=dtype)
+
+    def make_stacked(n):
+        linear = torch.nn.Linear(dim, dim, bias=False).to(device, dtype)
+        lora = LoRAModule("bench", linear).to(device, dtype)
+        lora.apply()
+        downs = [torch.randn(rank, dim, device=device, dtype=dtype) for _ in range(n)]
+        ups = [torch.randn(dim, rank, device=device, dtype=dtype) for _ in range(n)]
+        lora.set_weights(downs, ups, [(i, rank, 1.0) for i in range(n)], [1.0] * n)
+        lora.enable = n > 0
+        return linear
+
+    def make_chained(n):
+        linear = torch.nn.Linear(dim, dim, bias=False).to(device, dtype)
+        for i in range(n):
+            lora = LoRAModule(f"bench_{i}", linear, lora_dim=rank).to(device, dtype)
+            lora.apply()
+            lora.enable = True
+        return linear
+
+    print(f"device={device}, dtype={dtype}, rank={rank}, x={tuple(x.shape)}")
+    print(f"{'loras':>5} {'stacked ms':>12} {'chained ms':>12}")
+    with torch.no_grad():
+        for n in range(max_loras + 1):
+            stacked, chained = make_stacked(n), make_chained(n)
+            print(f"{n:>5} {timeit(lambda: stacked(x)):>12.3f} {timeit(lambda: chained(x)):>12.3f}")
+
+
+def bench_attention(latent_sizes=(64, 96), heads=8, head_dim=40, q_bucket_size=512, k_bucket_size=1024):
+    """
+    self-attention of the first U-Net block (batch 2 for CFG, one token per latent pixel) with FlashAttentionFunction
+    and with the inference only flash_attention_inference, which reuses its workspaces.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+
+    print(f"device={device}, dtype={dtype}, heads={heads}, head_dim={head_dim}")
+    print(f"{'latent':>7} {'function ms':>12} {'inference ms':>13} {'max diff':>9}")
+    with torch.no_grad():
+        for size in latent_sizes:
+            q, k, v = (torch.randn(2 * heads, size * size, head_dim, device=device, dtype=dtype) for _ in range(3))
+
+            def function():
+                return FlashAttentionFunction.apply(q, k, v, None, False, q_bucket_size, k_bucket_size)
+
+            def inference():
+                return flash_attention_inference(q, k, v, None, q_bucket_size, k_bucket_size)
+
+            diff = (function().float() - inference().float()).abs().max().item()
+            repeat = 20 if device == "cuda" else 3
+            t_function = timeit(function, repeat=repeat, warmup=1)
+            t_inference = timeit(inference, repeat=repeat, warmup=1)
+            print(f"{size:>3}x{size:<3} {t_function:>12.3f} {t_inference:>13.3f} {diff:>9.2e}")
+
+
+benchmarks = {
+    "lora": bench_lora,
+    "attention": bench_attention,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
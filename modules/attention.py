@@ -0,0 +1,478 @@
+# Attention backends
+# Every backend computes softmax(q k^T / sqrt(dim)) v for query/key/value of shape (batch * heads, length, dim), as
+# head_to_batch_dim returns them. Shapes are tuned ahead of time with tune(): each available backend (with each of its
+# options, within a memory and time budget) is timed, and the fastest one is used for that shape from then on.
+# Decisions are kept on disk, per device, so the benchmark only runs once per machine.
+
+import math
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+from torch import einsum
+from torch.autograd.function import Function
+
+from modules.cache import cache_path, read_json, write_json
+
+xformers_available = False
+try:
+    import xformers
+    import xformers.ops
+
+    xformers_available = True
+except ImportError:
+    pass
+
+EPSILON = 1e-6
+exists = lambda val: val is not None
+
+
+def sdpa_attention(query, key, value, attention_mask=None):
+    return F.scaled_dot_product_attention(
+        query.unsqueeze(0), key.unsqueeze(0), value.unsqueeze(0),
+        attn_mask=attention_mask.unsqueeze(0) if attention_mask is not None else None,
+    ).squeeze(0)
+
+
+def xformers_attention(query, key, value, attention_mask=None):
+    return xformers.ops.memory_efficient_attention(query, key, value, attn_bias=attention_mask)
+
+
+def flash_attention(query, key, value, attention_mask=None, q_bucket_size=512, k_bucket_size=1024):
+    return FlashAttentionFunction.apply(query, key, value, attention_mask, False, q_bucket_size, k_bucket_size)
+
+
+workspaces = threading.local()  # per thread, since requests may run concurrently
+MAX_WORKSPACE_BYTES = 256 * 1024 ** 2  # per thread; larger workspaces are allocated for each call instead
+
+
+def get_workspace(name, shape, dtype, device):
+    """
+    a scratch tensor of the given shape, viewed from a buffer that is allocated once per name, dtype and device and only
+    grows when a larger shape is needed, so memory is bounded by the largest shape seen instead of adding up over shapes.
+    Past MAX_WORKSPACE_BYTES for the thread, the tensor comes from the caching allocator and isn't kept.
+    """
+    if not hasattr(workspaces, "buffers"):
+        workspaces.buffers = {}
+
+    key = (name, dtype, device)
+    numel = math.prod(shape)
+    buffer = workspaces.buffers.get(key, None)
+    if buffer is None or buffer.numel() < numel:
+        del buffer
+        workspaces.buffers.pop(key, None)  # release the old buffer before allocating the new one
+        kept = sum(kept.numel() * kept.element_size() for kept in workspaces.buffers.values())
+        if kept + numel * torch.empty((), dtype=dtype).element_size() > MAX_WORKSPACE_BYTES:
+            return torch.empty(shape, dtype=dtype, device=device)
+        buffer = workspaces.buffers[key] = torch.empty(numel, dtype=dtype, device=device)
+    return buffer[:numel].view(shape)
+
+
+def release_workspaces():
+    """frees the workspaces of the calling thread, e.g. at the end of a request"""
+    workspaces.buffers = {}
+
+
+@torch.no_grad()
+def flash_attention_inference(query, key, value, attention_mask=None, q_bucket_size=512, k_bucket_size=1024):
+    """
+    inference only version of FlashAttentionFunction.forward: same bucketed online softmax, but scores and row
+    statistics live in workspaces reused across calls, updates are done in place, and nothing is kept for backward.
+    Like the original, the output stays normalized after every bucket, so it can't overflow in half precision.
+    attention_mask is additive, of shape (batch * heads, 1, key length).
+    """
+    batch_heads, q_len, _ = query.shape
+    k_len = key.shape[1]
+    q_bucket_size, k_bucket_size = min(q_bucket_size, q_len), min(k_bucket_size, k_len)
+    dtype, device = query.dtype, query.device
+    scale = query.shape[-1] ** -0.5
+    max_neg_value = -torch.finfo(dtype).max
+
+    hidden_states = torch.empty((batch_heads, q_len, value.shape[-1]), dtype=dtype, device=device)
+    scores_ws = get_workspace("scores", (batch_heads, q_bucket_size, k_bucket_size), dtype, device)
+    row_maxes_ws = get_workspace("row_maxes", (batch_heads, q_bucket_size, 1), dtype, device)
+    block_maxes_ws = get_workspace("block_maxes", (batch_heads, q_bucket_size, 1), dtype, device)
+    new_maxes_ws = get_workspace("new_maxes", (batch_heads, q_bucket_size, 1), dtype, device)
+    row_sums_ws = get_workspace("row_sums", (batch_heads, q_bucket_size, 1), torch.float32, device)
+    block_sums_ws = get_workspace("block_sums", (batch_heads, q_bucket_size, 1), torch.float32, device)
+
+    for q_start in range(0, q_len, q_bucket_size):
+        q_end = min(q_start + q_bucket_size, q_len)
+        rows = q_end - q_start
+        qc, oc = query[:, q_start:q_end], hidden_states[:, q_start:q_end]
+        row_maxes, row_sums = row_maxes_ws[:, :rows], row_sums_ws[:, :rows]
+        block_maxes, new_maxes, block_sums = block_maxes_ws[:, :rows], new_maxes_ws[:, :rows], block_sums_ws[:, :rows]
+
+        oc.zero_()
+        row_maxes.fill_(max_neg_value)
+        row_sums.zero_()
+
+        for k_start in range(0, k_len, k_bucket_size):
+            k_end = min(k_start + k_bucket_size, k_len)
+            scores = scores_ws[:, :rows, :k_end - k_start]
+
+            scores.baddbmm_(qc, key[:, k_start:k_end].transpose(-1, -2), beta=0, alpha=scale)
+            if attention_mask is not None:
+                scores.add_(attention_mask[:, :, k_start:k_end])
+
+            torch.amax(scores, dim=-1, keepdim=True, out=block_maxes)
+            torch.maximum(row_maxes, block_maxes, out=new_maxes)
+            scores.sub_(new_maxes).exp_()
+            torch.sum(scores, dim=-1, keepdim=True, dtype=torch.float32, out=block_sums)
+
+            # row_maxes becomes the correction of what was accumulated with the previous max, block_sums the new row
+            # sums and row_sums the weight of the previous output in the new one
+            row_maxes.sub_(new_maxes).exp_()
+            row_sums.mul_(row_maxes)
+            block_sums.add_(row_sums)
+            row_sums.div_(block_sums)
+
+            oc.mul_(row_sums).baddbmm_(scores.div_(block_sums), value[:, k_start:k_end])
+            row_maxes.copy_(new_maxes)
+            row_sums.copy_(block_sums)
+
+    return hidden_states
+
+
+def sliced_attention(query, key, value, attention_mask=None, slice_size=8):
+    """attention with torch.baddbmm, over slices of the batch * heads dimension"""
+    scale = query.shape[-1] ** -0.5
+    hidden_states = torch.empty(
+        (*query.shape[:-1], value.shape[-1]), dtype=query.dtype, device=query.device
+    )
+
+    for start in range(0, query.shape[0], slice_size):
+        end = min(start + slice_size, query.shape[0])
+        scores = torch.baddbmm(
+            torch.empty(end - start, query.shape[1], key.shape[1], dtype=query.dtype, device=query.device),
+            query[start:end],
+            key[start:end].transpose(-1, -2),
+            beta=0,
+            alpha=scale,
+        )
+        if attention_mask is not None:
+            scores += attention_mask[start:end]
+        hidden_states[start:end] = torch.bmm(scores.softmax(dim=-1), value[start:end])
+
+    return hidden_states
+
+
+def sliced_memory(query, key, slice_size=8):
+    return 2 * min(slice_size, query.shape[0]) * query.shape[1] * key.shape[1] * query.element_size()
+
+
+def flash_memory(query, key, q_bucket_size=512, k_bucket_size=1024):
+    # FlashAttentionFunction keeps the scores, their exp and a copy for the masked fill alive together
+    return 3 * query.shape[0] * min(q_bucket_size, query.shape[1]) * min(k_bucket_size, key.shape[1]) * query.element_size()
+
+
+def flash_inference_memory(query, key, q_bucket_size=512, k_bucket_size=1024):
+    return query.shape[0] * min(q_bucket_size, query.shape[1]) * min(k_bucket_size, key.shape[1]) * query.element_size()
+
+
+bucket_options = [{"q_bucket_size": q, "k_bucket_size": k} for q in (256, 512, 1024) for k in (1024, 4096)]
+
+# name -> (function, list of options to try, whether it accepts an additive attention mask,
+#          function of (query, key, **options) estimating the memory used for scores), tried in this order
+backends = {}
+if hasattr(F, "scaled_dot_product_attention"):
+    backends["sdpa"] = (sdpa_attention, [{}], True, lambda query, key: 0)
+if xformers_available:
+    backends["xformers"] = (xformers_attention, [{}], True, lambda query, key: 0)
+backends["flash_inference"] = (flash_attention_inference, bucket_options, True, flash_inference_memory)
+backends["flash"] = (flash_attention, bucket_options, False, flash_memory)
+backends["sliced"] = (sliced_attention, [{"slice_size": s} for s in (2, 8, 32)], True, sliced_memory)
+
+MAX_SCORES_BYTES = 1024 ** 3  # candidates estimated to need more memory than this for scores aren't tried
+MAX_TUNING_SECONDS = 5.0  # per shape; candidates are not tried anymore past this
+
+decisions = None  # "batch_heads,q_len,k_len,head_dim,dtype,device" -> [backend name, options], as saved on disk
+selected = {}  # (batch_heads, q_len, k_len, head_dim, dtype, device, masked) -> (function, options), for quick lookups
+device_names = {}
+
+
+def device_name(device):
+    if device not in device_names:
+        device_names[device] = torch.cuda.get_device_name(device) if device.type == "cuda" else device.type
+    return device_names[device]
+
+
+def shape_key(query, key):
+    return f"{query.shape[0]},{query.shape[1]},{key.shape[1]},{query.shape[-1]},{query.dtype},{device_name(query.device)}"
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_candidate(name, options, query, key, value, attention_mask=None, repeat=3):
+    """average time of a backend with options on the given inputs, or None if it fails"""
+    fn = backends[name][0]
+    try:
+        start = time.perf_counter()
+        fn(query, key, value, attention_mask, **options)  # warmup
+        synchronize(query.device)
+        elapsed = time.perf_counter() - start
+
+        # slow candidates are timed once, so that tuning stays quick on cpu
+        runs = repeat if elapsed < 0.25 else 0
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn(query, key, value, attention_mask, **options)
+        synchronize(query.device)
+        return (time.perf_counter() - start) / runs if runs > 0 else elapsed
+    except Exception as e:  # unsupported dtype/device/shape, out of memory...
+        print(f"Attention backend {name} {options} failed: {e}")
+        return None
+
+
+def benchmark(query, key, value, attention_mask=None, repeat=3):
+    """
+    times the backends and options on the given inputs and returns the fastest as (name, options). Candidates that
+    would need too much memory are skipped, and tuning stops early once it has taken MAX_TUNING_SECONDS. If none of
+    them fits the budget, the others are tried by increasing memory, and the first one that works is returned.
+    Returns None if every candidate failed.
+    """
+    tuning_start = time.perf_counter()
+    candidates = [
+        (memory(query, key, **options), name, options)
+        for name, (_, options_list, accepts_mask, memory) in backends.items()
+        for options in options_list
+        if attention_mask is None or accepts_mask
+    ]
+
+    timings = []
+    for memory, name, options in candidates:
+        if memory > MAX_SCORES_BYTES:
+            continue
+        if len(timings) > 0 and time.perf_counter() - tuning_start > MAX_TUNING_SECONDS:
+            break
+
+        elapsed = time_candidate(name, options, query, key, value, attention_mask, repeat)
+        if elapsed is not None:
+            timings.append((elapsed, name, options))
+
+    if len(timings) > 0:
+        _, name, options = min(timings, key=lambda timing: timing[0])
+        return name, options
+
+    over_budget = [candidate for candidate in candidates if candidate[0] > MAX_SCORES_BYTES]
+    for _, name, options in sorted(over_budget, key=lambda candidate: candidate[0]):
+        if time_candidate(name, options, query, key, value, attention_mask, repeat=0) is not None:
+            return name, options
+
+    return None
+
+
+def select_backend(query, key, value, attention_mask=None, tune=False):
+    """
+    the backend for the shape of the inputs, as [name, options]. Shapes are normally tuned ahead of time with tune();
+    for a shape that wasn't, sdpa is used without tuning when available, so requests never wait for a benchmark.
+    """
+    global decisions
+
+    path = cache_path("attention_backends.json")
+    if decisions is None:
+        decisions = read_json(path, {})
+
+    decision_key = shape_key(query, key) + (",mask" if attention_mask is not None else "")
+    decision = decisions.get(decision_key, None)
+    if decision is not None and decision[0] in backends:
+        return decision
+
+    if not tune and "sdpa" in backends:
+        return ["sdpa", {}]
+
+    decision = benchmark(query, key, value, attention_mask)
+    if decision is None:
+        # not saved, so that the shape is tuned again next time
+        print(f"No attention backend worked for {decision_key}")
+        return ["sdpa", {}] if "sdpa" in backends else ["sliced", {}]
+
+    decision = list(decision)
+    print(f"Attention backend for {decision_key}: {decision[0]} {decision[1]}")
+    decisions[decision_key] = decision
+    write_json(path, decisions)
+    return decision
+
+
+@torch.no_grad()
+def tune(shapes, dtype, device):
+    """tunes the backends for shapes, a list of (batch * heads, query length, key length, head dim), e.g. at startup"""
+    for batch_heads, q_len, k_len, head_dim in shapes:
+        query = torch.randn(batch_heads, q_len, head_dim, dtype=dtype, device=device)
+        key = torch.randn(batch_heads, k_len, head_dim, dtype=dtype, device=device)
+        value = torch.randn(batch_heads, k_len, head_dim, dtype=dtype, device=device)
+        select_backend(query, key, value, tune=True)
+    release_workspaces()
+
+
+def attention(query, key, value, attention_mask=None):
+    """attention with the fastest backend for the shape of the inputs"""
+    lookup_key = (query.shape[0], query.shape[1], key.shape[1], query.shape[-1], query.dtype, query.device, attention_mask is not None)
+    if lookup_key not in selected:
+        name, options = select_backend(query, key, value, attention_mask)
+        selected[lookup_key] = (backends[name][0], options)
+
+    fn, options = selected[lookup_key]
+    return fn(query, key, value, attention_mask, **options)
+
+
+class FlashAttentionFunction(Function):
+    @staticmethod
+    @torch.no_grad()
+    def forward(ctx, q, k, v, mask, causal, q_bucket_size, k_bucket_size):
+        """Algorithm 2 in the paper"""
+
+        device = q.device
+        max_neg_value = -torch.finfo(q.dtype).max
+        qk_len_diff = max(k.shape[-2] - q.shape[-2], 0)
+
+        o = torch.zeros_like(q)
+        all_row_sums = torch.zeros((*q.shape[:-1], 1), device=device)
+        all_row_maxes = torch.full((*q.shape[:-1], 1), max_neg_value, device=device)
+
+        scale = q.shape[-1] ** -0.5
+
+        if not exists(mask):
+            mask = (None,) * math.ceil(q.shape[-2] / q_bucket_size)
+        else:
+            mask = rearrange(mask, "b n -> b 1 1 n")
+            mask = mask.split(q_bucket_size, dim=-1)
+
+        row_splits = zip(
+            q.split(q_bucket_size, dim=-2),
+            o.split(q_bucket_size, dim=-2),
+            mask,
+            all_row_sums.split(q_bucket_size, dim=-2),
+            all_row_maxes.split(q_bucket_size, dim=-2),
+        )
+
+        for ind, (qc, oc, row_mask, row_sums, row_maxes) in enumerate(row_splits):
+            q_start_index = ind * q_bucket_size - qk_len_diff
+
+            col_splits = zip(
+                k.split(k_bucket_size, dim=-2),
+                v.split(k_bucket_size, dim=-2),
+            )
+
+            for k_ind, (kc, vc) in enumerate(col_splits):
+                k_start_index = k_ind * k_bucket_size
+
+                attn_weights = einsum("... i d, ... j d -> ... i j", qc, kc) * scale
+
+                if exists(row_mask):
+                    attn_weights.masked_fill_(~row_mask, max_neg_value)
+
+                if causal and q_start_index < (k_start_index + k_bucket_size - 1):
+                    causal_mask = torch.ones(
+                        (qc.shape[-2], kc.shape[-2]), dtype=torch.bool, device=device
+                    ).triu(q_start_index - k_start_index + 1)
+                    attn_weights.masked_fill_(causal_mask, max_neg_value)
+
+                block_row_maxes = attn_weights.amax(dim=-1, keepdims=True)
+                attn_weights -= block_row_maxes
+                exp_weights = torch.exp(attn_weights)
+
+                if exists(row_mask):
+                    exp_weights.masked_fill_(~row_mask, 0.0)
+
+                block_row_sums = exp_weights.sum(dim=-1, keepdims=True).clamp(
+                    min=EPSILON
+                )
+
+                new_row_maxes = torch.maximum(block_row_maxes, row_maxes)
+
+                exp_values = einsum("... i j, ... j d -> ... i d", exp_weights, vc)
+
+                exp_row_max_diff = torch.exp(row_maxes - new_row_maxes)
+                exp_block_row_max_diff = torch.exp(block_row_maxes - new_row_maxes)
+
+                new_row_sums = (
+                    exp_row_max_diff * row_sums
+                    + exp_block_row_max_diff * block_row_sums
+                )
+
+                oc.mul_((row_sums / new_row_sums) * exp_row_max_diff).add_(
+                    (exp_block_row_max_diff / new_row_sums) * exp_values
+                )
+
+                row_maxes.copy_(new_row_maxes)
+                row_sums.copy_(new_row_sums)
+
+        lse = all_row_sums.log() + all_row_maxes
+
+        ctx.args = (causal, scale, mask, q_bucket_size, k_bucket_size)
+        ctx.save_for_backward(q, k, v, o, lse)
+
+        return o
+
+    @staticmethod
+    @torch.no_grad()
+    def backward(ctx, do):
+        """Algorithm 4 in the paper"""
+
+        causal, scale, mask, q_bucket_size, k_bucket_size = ctx.args
+        q, k, v, o, lse = ctx.saved_tensors
+
+        device = q.device
+
+        max_neg_value = -torch.finfo(q.dtype).max
+        qk_len_diff = max(k.shape[-2] - q.shape[-2], 0)
+
+        dq = torch.zeros_like(q)
+        dk = torch.zeros_like(k)
+        dv = torch.zeros_like(v)
+
+        row_splits = zip(
+            q.split(q_bucket_size, dim=-2),
+            o.split(q_bucket_size, dim=-2),
+            do.split(q_bucket_size, dim=-2),
+            mask,
+            lse.split(q_bucket_size, dim=-2),
+            dq.split(q_bucket_size, dim=-2),
+        )
+
+        for ind, (qc, oc, doc, row_mask, lsec, dqc) in enumerate(row_splits):
+            q_start_index = ind * q_bucket_size - qk_len_diff
+
+            col_splits = zip(
+                k.split(k_bucket_size, dim=-2),
+                v.split(k_bucket_size, dim=-2),
+                dk.split(k_bucket_size, dim=-2),
+                dv.split(k_bucket_size, dim=-2),
+            )
+
+            for k_ind, (kc, vc, dkc, dvc) in enumerate(col_splits):
+                k_start_index = k_ind * k_bucket_size
+
+                attn_weights = einsum("... i d, ... j d -> ... i j", qc, kc) * scale
+
+                if causal and q_start_index < (k_start_index + k_bucket_size - 1):
+                    causal_mask = torch.ones(
+                        (qc.shape[-2], kc.shape[-2]), dtype=torch.bool, device=device
+                    ).triu(q_start_index - k_start_index + 1)
+                    attn_weights.masked_fill_(causal_mask, max_neg_value)
+
+                p = torch.exp(attn_weights - lsec)
+
+                if exists(row_mask):
+                    p.masked_fill_(~row_mask, 0.0)
+
+                dv_chunk = einsum("... i j, ... i d -> ... j d", p, doc)
+                dp = einsum("... i d, ... j d -> ... i j", doc, vc)
+
+                D = (doc * oc).sum(dim=-1, keepdims=True)
+                ds = p * scale * (dp - D)
+
+                dq_chunk = einsum("... i j, ... j d -> ... i d", ds, kc)
+                dk_chunk = einsum("... i j, ... i d -> ... j d", ds, qc)
+
+                dqc.add_(dq_chunk)
+                dkc.add_(dk_chunk)
+                dvc.add_(dv_chunk)
+
+        return dq, dk, dv, None, None, None, None
@@ -0,0 +1,48 @@
+# On-disk caches
+# Small json indexes kept under one directory, set with the UIMIN_CACHE_DIR environment variable. They are only
+# an optimization: a missing or unreadable index is the same as an empty one.
+
+import hashlib
+import json
+import os
+import tempfile
+
+CACHE_DIR = os.environ.get("UIMIN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "uimin"))
+
+
+def cache_path(*names):
+    """path of a file in the cache directory, creating its parent directories"""
+    path = os.path.join(CACHE_DIR, *names)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    except OSError:
+        pass  # reads and writes fail later, like with a missing index
+    return path
+
+
+def file_hash(path):
+    """sha256 of the content of a file"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_json(path, default=None):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, value):
+    """replaces the file atomically, so that readers never see a partially written index"""
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not write cache file {path}: {e}")
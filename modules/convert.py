@@ -0,0 +1,122 @@
+# Conversion cache of pickle checkpoints
+# The first time a .pt file is loaded (and verified by modules.safe), its tensors are saved as safetensors in the
+# cache directory, named after the hash of the content of the .pt file. Later loads of the same content are memory
+# mapped reads of the converted file, without unpickling. The least recently used files are evicted past MAX_CACHE_BYTES.
+
+import json
+import os
+import torch
+import modules.safe as safe
+from safetensors import safe_open
+from safetensors.torch import save_file
+from modules.cache import cache_path
+
+MAX_CACHE_BYTES = 4 * 1024 ** 3
+SEPARATOR = "/"  # joins the keys of nested dicts
+
+
+def flatten(state, path, tensors, items):
+    """
+    collects the tensors of a nested dict by joined key, and lists every entry in order in items, as [path, "tensor"]
+    for tensors and [path, "value", value] for anything else
+    """
+    for key, value in state.items():
+        if not isinstance(key, str) or SEPARATOR in key:
+            raise ValueError(f"unsupported key: {key!r}")
+
+        key_path = path + [key]
+        if isinstance(value, torch.Tensor):
+            tensors[SEPARATOR.join(key_path)] = value.detach().to("cpu").clone()  # no shared storages in safetensors
+            items.append([key_path, "tensor"])
+        elif isinstance(value, dict):
+            flatten(value, key_path, tensors, items)
+        else:
+            items.append([key_path, "value", value])
+
+
+def convert(state, path):
+    tensors, items = {}, []
+    flatten(state, [], tensors, items)
+    nested = len(tensors) != len(items) or any(isinstance(value, dict) for value in state.values())
+    metadata = {
+        "format": "pt",
+        "nested": "1" if nested else "0",
+        "items": json.dumps(items),  # safetensors doesn't keep the order of keys
+    }
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        save_file(tensors, tmp, metadata=metadata)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_converted(path, device="cpu", key_filter=None):
+    with safe_open(path, framework="pt", device=str(device)) as f:
+        metadata = f.metadata() or {}
+        if "items" not in metadata:
+            raise ValueError("converted by an older version")
+
+        items = json.loads(metadata["items"])
+        if metadata.get("nested") != "1":
+            keys = [key_path[0] for key_path, _ in items]
+            return {key: f.get_tensor(key) for key in keys if key_filter is None or key_filter(key)}
+
+        # rebuilt in the original order, tensors and other values interleaved
+        state = {}
+        for key_path, kind, *value in items:
+            value = f.get_tensor(SEPARATOR.join(key_path)) if kind == "tensor" else value[0]
+            parent = state
+            for key in key_path[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[key_path[-1]] = value
+        return state
+
+
+def evict(directory, max_bytes, keep=None):
+    """removes the least recently used converted files until the total size is below max_bytes"""
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".safetensors"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def load_state_dict(filename, device="cpu", key_filter=None):
+    """
+    torch.load for .pt files through the conversion cache. Tensors are loaded to device. key_filter is a function of a key
+    that tells which tensors are needed; for flat state dicts loaded from the cache, other tensors are not read at all.
+    Returns None if the file could not be verified, like modules.safe.load.
+    """
+    path = cache_path("converted", f"{safe.content_hash(filename)}.safetensors")
+    if os.path.exists(path):
+        try:
+            state = read_converted(path, device, key_filter)
+            os.utime(path)  # most recently used
+            return state
+        except Exception as e:
+            print(f"Could not read converted file {path}, converting {filename} again: {e}")
+
+    state = torch.load(filename, map_location=device)
+    if isinstance(state, dict):
+        try:
+            convert(state, path)
+            evict(os.path.dirname(path), MAX_CACHE_BYTES, keep=path)
+        except (ValueError, TypeError, OSError) as e:
+            print(f"Could not convert {filename} to safetensors: {e}")
+
+    return state
@@ -0,0 +1,105 @@
+# Textual inversion embedding registry
+# Embedding files are loaded once, identified by the hash of their content, and get stable tokens in the tokenizer
+# and stable rows in a preallocated reserve region at the end of the text encoder's token embedding table.
+
+import os
+import modules.safe as _
+from safetensors.torch import load_file
+from modules.cache import file_hash
+from modules.convert import load_state_dict
+
+
+def load_vectors(path):
+    """loads an embedding file and returns its vectors as a (n, dim) tensor on cpu"""
+
+    if str(path).endswith(".pt"):
+        loaded = load_state_dict(path)
+    else:
+        loaded = load_file(path, device="cpu")
+
+    if "string_to_param" in loaded:
+        loaded = loaded["string_to_param"]["*"]
+    elif isinstance(loaded, dict):
+        loaded = loaded["emb_params"] if "emb_params" in loaded else next(iter(loaded.values()))
+
+    vectors = loaded.detach()
+    if vectors.dim() == 1:
+        vectors = vectors.unsqueeze(0)
+    return vectors
+
+
+class EmbeddingRegistry:
+    """
+    Keeps track of every embedding seen so far for one tokenizer. Each embedding gets its tokens in the tokenizer the first
+    time it's used, named after its content hash; token ids never change afterwards, so the rows of the token embedding
+    table belonging to an embedding only have to be written once per text encoder.
+    The table of a text encoder is grown by a whole reserve at a time, so activating embeddings normally is just a copy
+    of their vectors, or nothing at all when they are already resident.
+    """
+
+    def __init__(self, tokenizer, reserve=256):
+        self.tokenizer = tokenizer
+        self.reserve = reserve
+        self.hashes = {}  # (path, size, mtime) -> content hash
+        self.vectors = {}  # content hash -> tensor of vectors
+        self.tokens = {}  # content hash -> list of token names
+        self.resident = {}  # id(text_encoder) -> set of content hashes written into its table
+
+    def load(self, path):
+        """loads an embedding file, unless a file with the same content was loaded before; returns its content hash"""
+
+        stat = os.stat(path)
+        file_key = (str(path), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self.hashes:
+            self.hashes[file_key] = file_hash(path)
+
+        h = self.hashes[file_key]
+        if h not in self.vectors:
+            self.vectors[h] = load_vectors(path)
+
+        return h
+
+    def get_tokens(self, h):
+        if h not in self.tokens:
+            tokens = [f"emb-{h[:16]}-{i}" for i in range(self.vectors[h].shape[0])]
+            self.tokenizer.add_tokens(tokens)
+            self.tokens[h] = tokens
+
+        return self.tokens[h]
+
+    def ensure_capacity(self, text_encoder):
+        """grows the token embedding table of text_encoder, by a multiple of the reserve, until every token fits"""
+
+        rows = text_encoder.get_input_embeddings().weight.shape[0]
+        needed = len(self.tokenizer)
+        if needed <= rows:
+            return
+
+        reserve = self.reserve
+        while rows + reserve < needed:
+            reserve *= 2
+
+        text_encoder.resize_token_embeddings(rows + reserve)
+
+    def activate(self, text_encoder, embs):
+        """
+        makes the embeddings in embs (a dict of name -> file path) usable with text_encoder.
+        Returns a dict of name -> list of token names that the name should be replaced with in prompts.
+        """
+
+        hashes = {name: self.load(path) for name, path in embs.items()}
+        names = {name: self.get_tokens(h) for name, h in hashes.items()}
+
+        self.ensure_capacity(text_encoder)
+
+        resident = self.resident.setdefault(id(text_encoder), set())
+        token_embeds = text_encoder.get_input_embeddings().weight.data
+        for name, h in hashes.items():
+            if h in resident:
+                continue
+
+            ids = self.tokenizer.convert_tokens_to_ids(names[name])
+            token_embeds[ids] = self.vectors[h].to(token_embeds.device, dtype=token_embeds.dtype)
+            resident.add(h)
+
+        return names
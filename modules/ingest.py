@@ -0,0 +1,80 @@
+# Bulk ingest of uploaded embedding/LoRA files
+# Files are verified, converted and classified in a pool of worker processes: unpickling is cpu-bound and holds the
+# GIL, so doing it in the server process blocks everything else. The verification and conversion caches are on disk,
+# so the server process later loads the same files without doing that work again.
+
+import multiprocessing
+import os
+import time
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from safetensors import safe_open
+from modules.convert import load_state_dict
+
+MAX_WORKERS = 4
+pool = None
+
+
+def init_worker():
+    torch.set_num_threads(1)
+
+
+def start_pool():
+    """
+    starts the worker processes. Workers are forked, which is only safe before the parent initializes cuda or starts
+    threads: this has to be called at startup, before the models are loaded. A pool that breaks later isn't restarted,
+    files are then classified in the calling process instead.
+    """
+    global pool
+
+    if pool is not None:
+        return
+
+    # fork: the app module has no main guard, so spawned workers would import (and start) the whole app
+    workers = min(MAX_WORKERS, os.cpu_count() or 1)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=init_worker,
+    )
+
+    # workers are created on demand: keep all of them busy at once so that every one of them is forked now
+    for future in [pool.submit(time.sleep, 0.1) for _ in range(workers)]:
+        future.result()
+
+
+def classify(path):
+    """returns "lora" or "embedding" for a file, loading it only as far as needed"""
+    if os.path.splitext(path)[1] == ".pt":
+        state_dict = load_state_dict(path)
+        if state_dict is None:
+            raise ValueError(f"{path} could not be verified")
+        keys = state_dict.keys()
+    else:
+        with safe_open(path, framework="pt", device="cpu") as f:
+            keys = list(f.keys())
+
+    return "lora" if any("lora" in k for k in keys) else "embedding"
+
+
+def ingest(paths):
+    """classifies files in parallel, and yields (path, kind, error) for each of them as soon as it's done"""
+    global pool
+
+    if len(paths) <= 1 or pool is None:
+        for path in paths:
+            try:
+                yield path, classify(path), None
+            except Exception as e:
+                yield path, None, e
+        return
+
+    futures = {pool.submit(classify, path): path for path in paths}
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                pool = None  # a worker died; forking new ones now would be unsafe, see start_pool()
+            yield futures[future], None, e
@@ -4,17 +4,43 @@
 # https://github.com/cloneofsimo/lora/blob/master/lora_diffusion/lora.py
 # https://github.com/bmaltais/kohya_ss/blob/master/networks/lora.py#L48
 
+import hashlib
+import json
 import math
 import os
+from collections import OrderedDict
 import torch
 import diffusers
+import transformers
 import modules.safe as _
-from safetensors.torch import load_file
+from safetensors import safe_open
+from modules.cache import cache_path, read_json, write_json
+from modules.convert import load_state_dict
+
+
+def file_key(file):
+    """identifies a version of a file on disk: path, modification time and size"""
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_mtime_ns, stat.st_size
+
+
+RANK_BUCKETS = [4, 8, 16, 32, 64, 128]
+
+
+def rank_bucket(rank):
+    """smallest bucket that fits rank; ranks above the largest bucket are rounded up to a multiple of it"""
+    for bucket in RANK_BUCKETS:
+        if rank <= bucket:
+            return bucket
+    return -(-rank // RANK_BUCKETS[-1]) * RANK_BUCKETS[-1]
 
 
 class LoRAModule(torch.nn.Module):
     """
     replaces forward method of the original Linear, instead of replacing the original Linear module.
+    Several LoRAs can be stacked on one module: their down/up weights are concatenated along the rank dimension, so any
+    number of them costs a single pair of matmuls. rank_scale holds multiplier * alpha / rank for every rank.
+    The down/up layers are preallocated per rank bucket and reused across loads; ranks past the loaded ones are zero.
     """
 
     def __init__(
@@ -30,59 +56,211 @@ class LoRAModule(torch.nn.Module):
         self.lora_name = lora_name
         self.lora_dim = lora_dim
 
-        if org_module.__class__.__name__ == "Conv2d":
-            in_dim = org_module.in_channels
-            out_dim = org_module.out_channels
-            self.lora_down = torch.nn.Conv2d(in_dim, lora_dim, (1, 1), bias=False)
-            self.lora_up = torch.nn.Conv2d(lora_dim, out_dim, (1, 1), bias=False)
+        self.is_conv = org_module.__class__.__name__ == "Conv2d"
+        if self.is_conv:
+            self.in_dim, self.out_dim = org_module.in_channels, org_module.out_channels
         else:
-            in_dim = org_module.in_features
-            out_dim = org_module.out_features
-            self.lora_down = torch.nn.Linear(in_dim, lora_dim, bias=False)
-            self.lora_up = torch.nn.Linear(lora_dim, out_dim, bias=False)
+            self.in_dim, self.out_dim = org_module.in_features, org_module.out_features
+
+        self.bucket_layers = torch.nn.ModuleDict()  # str(bucket) -> (down, up) layers with bucket ranks
+        self.bucket = None
+        self.resize(lora_dim)
 
         if type(alpha) == torch.Tensor:
             alpha = alpha.detach().float().numpy()  # without casting, bf16 causes error
 
         alpha = lora_dim if alpha is None or alpha == 0 else alpha
-        self.scale = alpha / self.lora_dim
-        self.register_buffer("alpha", torch.tensor(alpha))  # 定数として扱える
+        self.register_buffer("rank_scale", torch.zeros(self.bucket))
+        self.rank_scale[:lora_dim] = float(multiplier * alpha / lora_dim)
 
         # same as microsoft's
-        torch.nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
-        torch.nn.init.zeros_(self.lora_up.weight)
+        torch.nn.init.kaiming_uniform_(self.lora_down.weight[:lora_dim], a=math.sqrt(5))
 
-        self.multiplier = multiplier
+        self.segments = [(0, lora_dim, float(alpha / lora_dim))]  # (index in the stack, rank, alpha / rank) of each stacked LoRA
+        self.sample_scale = None  # (batch, rank) scales for per-sample LoRA selection, see set_sample_adapters()
         self.org_module = org_module  # remove in applying
+        self.merged = False
         self.enable = False
+        self.org_weight = None
 
-    def resize(self, rank, alpha, multiplier):
-        self.alpha = torch.tensor(alpha)
-        self.multiplier = multiplier
-        self.scale = alpha / rank
-        if self.lora_down.__class__.__name__ == "Conv2d":
-            in_dim = self.lora_down.in_channels
-            out_dim = self.lora_up.out_channels
-            self.lora_down = torch.nn.Conv2d(in_dim, rank, (1, 1), bias=False)
-            self.lora_up = torch.nn.Conv2d(rank, out_dim, (1, 1), bias=False)
+    @property
+    def lora_down(self):
+        return self.bucket_layers[str(self.bucket)][0]
+
+    @property
+    def lora_up(self):
+        return self.bucket_layers[str(self.bucket)][1]
+
+    def create_layers(self, bucket):
+        """zero initialized down/up layers of the given rank, on the device and dtype of the current ones"""
+        if self.bucket is None:
+            factory = {}
         else:
-            in_dim = self.lora_down.in_features
-            out_dim = self.lora_up.out_features
-            self.lora_down = torch.nn.Linear(in_dim, rank, bias=False)
-            self.lora_up = torch.nn.Linear(rank, out_dim, bias=False)
+            factory = {"device": self.lora_down.weight.device, "dtype": self.lora_down.weight.dtype}
+
+        if self.is_conv:
+            down = torch.nn.utils.skip_init(torch.nn.Conv2d, self.in_dim, bucket, (1, 1), bias=False, **factory)
+            up = torch.nn.utils.skip_init(torch.nn.Conv2d, bucket, self.out_dim, (1, 1), bias=False, **factory)
+        else:
+            down = torch.nn.utils.skip_init(torch.nn.Linear, self.in_dim, bucket, bias=False, **factory)
+            up = torch.nn.utils.skip_init(torch.nn.Linear, bucket, self.out_dim, bias=False, **factory)
+
+        for layer in (down, up):
+            layer.weight.requires_grad_(False)
+            layer.weight.zero_()
+        return torch.nn.ModuleList([down, up])
+
+    def resize(self, rank):
+        """
+        makes room for rank: the layers are sized to the bucket of rank (see rank_bucket()), and the layers of every
+        bucket are allocated once and then reused, so loading a LoRA is a copy into them. Unused ranks stay zero.
+        """
+        bucket = rank_bucket(rank)
+        if str(bucket) not in self.bucket_layers:
+            self.bucket_layers[str(bucket)] = self.create_layers(bucket)
+        self.bucket = bucket
+
+    def set_weights(self, downs, ups, segments, multipliers):
+        """
+        stacks LoRAs on this module: downs and ups are lists with the down/up weights of each of them, segments
+        describes them like self.segments does, and multipliers are the scales of the whole stack.
+        """
+        self.segments = segments
+        self.sample_scale = None
+        rank = sum(rank for _, rank, _ in segments)
+
+        if rank > 0:
+            self.resize(rank)
+            down_weight, up_weight = self.lora_down.weight.data, self.lora_up.weight.data
+            offset = 0
+            with torch.no_grad():
+                for down, up, (_, rank, _) in zip(downs, ups, segments):
+                    # some files store 1x1 conv weights for linear layers and the other way around
+                    down_slice, up_slice = down_weight[offset:offset + rank], up_weight[:, offset:offset + rank]
+                    down_slice.copy_(down.reshape(down_slice.shape))
+                    up_slice.copy_(up.reshape(up_slice.shape))
+                    offset += rank
+                down_weight[offset:].zero_()
+                up_weight[:, offset:].zero_()
+
+        self.set_multipliers(multipliers)
+
+    def scale_per_rank(self, values, fill):
+        """expands one value per segment to one value per rank of the bucket, padded with fill"""
+        per_rank = [value for value, (_, rank, _) in zip(values, self.segments) for _ in range(rank)]
+        return per_rank + [fill] * (self.bucket - len(per_rank))
+
+    def set_multipliers(self, multipliers):
+        self.touch()
+        weight = self.lora_down.weight
+        self.rank_scale = torch.tensor(
+            self.scale_per_rank([multipliers[index] * scale for index, _, scale in self.segments], 0.0),
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+
+    def set_sample_adapters(self, indices, scales):
+        """
+        per-sample mode: the i-th sample of the batch only gets the LoRA at position indices[i] in the stack (or none
+        if it's -1), with multiplier scales[i]. All samples still go through the same pair of matmuls; the ranks of
+        other LoRAs are zeroed per sample between the down and up projections. Passing None ends per-sample mode.
+        """
+        self.touch()
+        if indices is None:
+            self.sample_scale = None
+            return
+
+        weight = self.lora_down.weight
+        rank_index = torch.tensor(self.scale_per_rank([index for index, _, _ in self.segments], -2), device=weight.device)
+        rank_alpha = torch.tensor(self.scale_per_rank([scale for _, _, scale in self.segments], 0.0), device=weight.device)
+        indices = torch.as_tensor(indices, device=weight.device)
+        scales = torch.as_tensor(scales, device=weight.device, dtype=rank_alpha.dtype)
+
+        sample_scale = (rank_index[None, :] == indices[:, None]) * scales[:, None] * rank_alpha[None, :]
+        self.sample_scale = sample_scale.to(weight.dtype)
+
+    @property
+    def enable(self):
+        return self._enable
+
+    @enable.setter
+    def enable(self, enable):
+        self._enable = enable
+        self.update_forward()
 
     def apply(self):
         if hasattr(self, "org_module"):
             self.org_forward = self.org_module.forward
-            self.org_module.forward = self.forward
+            self.org_forward_is_default = "forward" not in self.org_module.__dict__
+            self.org_module_ref = [self.org_module]  # keep a reference without registering it as a submodule
             del self.org_module
+        self.update_forward()
+
+    def touch(self):
+        """bumps lora_version of the original module, which tells caches of its outputs that they're stale"""
+        if hasattr(self, "org_module_ref"):
+            org_module = self.org_module_ref[0]
+            org_module.lora_version = getattr(org_module, "lora_version", 0) + 1
+
+    def update_forward(self):
+        """
+        the wrapper is only installed on the original module while this LoRA is enabled and not merged; otherwise the
+        original forward is put back, so that untouched modules don't pay for a python call on every forward.
+        """
+        if not hasattr(self, "org_module_ref"):
+            return
+
+        self.touch()
+        org_module = self.org_module_ref[0]
+        if self.enable and not self.merged:
+            org_module.forward = self.forward
+        elif self.org_forward_is_default:
+            org_module.__dict__.pop("forward", None)
+        else:
+            org_module.forward = self.org_forward
+
+    def get_weight(self):
+        """returns the weight delta of this LoRA, to be added to the weight of the original module"""
+        down = self.lora_down.weight.float()
+        up = self.lora_up.weight.float()
+        if self.is_conv:
+            down, up = down.squeeze(3).squeeze(2), up.squeeze(3).squeeze(2)
+            return ((up * self.rank_scale.float()) @ down).unsqueeze(2).unsqueeze(3)
+        return (up * self.rank_scale.float()) @ down
+
+    def merge(self):
+        """folds the LoRA into the weight of the original module, and restores its original forward"""
+        if self.merged or not self.enable or self.sample_scale is not None:
+            return
+
+        org_module = self.org_module_ref[0]
+        weight = org_module.weight.data
+        self.org_weight = weight.to("cpu", copy=True)  # for exact unmerge
+        weight += self.get_weight().to(weight.device, dtype=weight.dtype)
+        self.merged = True
+        self.update_forward()
+
+    def unmerge(self):
+        if not self.merged:
+            return
+
+        org_module = self.org_module_ref[0]
+        org_module.weight.data.copy_(self.org_weight)
+        self.org_weight = None
+        self.merged = False
+        self.update_forward()
 
     def forward(self, x):
         if self.enable:
-            return (
-        self.org_forward(x)
-        + self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
-        )
+            h = self.lora_down(x)
+            scale = self.rank_scale if self.sample_scale is None else self.sample_scale
+            if self.is_conv:
+                h = h * scale.view(-1, scale.shape[-1], 1, 1)
+            elif self.sample_scale is not None:
+                h = h * scale.view(scale.shape[0], *([1] * (h.dim() - 2)), scale.shape[-1])
+            else:
+                h = h * scale
+            return self.org_forward(x) + self.lora_up(h)
         return self.org_forward(x)
 
 
@@ -91,6 +269,8 @@ class LoRANetwork(torch.nn.Module):
     TEXT_ENCODER_TARGET_REPLACE_MODULE = ["CLIPAttention", "CLIPMLP"]
     LORA_PREFIX_UNET = "lora_unet"
     LORA_PREFIX_TEXT_ENCODER = "lora_te"
+    WEIGHTS_CACHE_SIZE = 4
+    module_indexes = {}  # model config hash -> list of (lora name, module path), see module_index()
 
     def __init__(self, text_encoder, unet, multiplier=1.0, lora_dim=4, alpha=1) -> None:
         super().__init__()
@@ -100,16 +280,15 @@ class LoRANetwork(torch.nn.Module):
 
         # create module instances
         def create_modules(prefix, root_module: torch.nn.Module, target_replace_modules):
-            loras = []
-            for name, module in root_module.named_modules():
-                if module.__class__.__name__ in target_replace_modules:
-                    for child_name, child_module in module.named_modules():
-                        if child_module.__class__.__name__ == "Linear" or (child_module.__class__.__name__ == "Conv2d" and child_module.kernel_size == (1, 1)):
-                            lora_name = prefix + "." + name + "." + child_name
-                            lora_name = lora_name.replace(".", "_")
-                            lora = LoRAModule(lora_name, child_module, self.multiplier, self.lora_dim, self.alpha,)
-                            loras.append(lora)
-            return loras
+            index = LoRANetwork.module_index(prefix, root_module, target_replace_modules)
+            try:
+                modules = [(lora_name, root_module.get_submodule(path)) for lora_name, path in index]
+            except AttributeError:
+                # stale index on disk
+                index = LoRANetwork.module_index(prefix, root_module, target_replace_modules, rescan=True)
+                modules = [(lora_name, root_module.get_submodule(path)) for lora_name, path in index]
+
+            return [LoRAModule(lora_name, module, self.multiplier, self.lora_dim, self.alpha,) for lora_name, module in modules]
 
         if isinstance(text_encoder, list):
             self.text_encoder_loras = text_encoder
@@ -124,6 +303,9 @@ class LoRANetwork(torch.nn.Module):
         print(f"Create LoRA for U-Net: {len(self.unet_loras)} modules.")
 
         self.weights_sd = None
+        self.weights_cache = OrderedDict()
+        self.loaded_keys = []
+        self.multipliers = []
 
         # assertion
         names = set()
@@ -134,53 +316,201 @@ class LoRANetwork(torch.nn.Module):
             lora.apply()
             self.add_module(lora.lora_name, lora)
 
+        self.lora_names = names
+
+    @staticmethod
+    def find_modules(prefix, root_module: torch.nn.Module, target_replace_modules):
+        """walks the module tree and returns the (lora name, module path) of every module that gets a LoRA"""
+        index = []
+        for name, module in root_module.named_modules():
+            if module.__class__.__name__ in target_replace_modules:
+                for child_name, child_module in module.named_modules():
+                    if child_module.__class__.__name__ == "Linear" or (child_module.__class__.__name__ == "Conv2d" and child_module.kernel_size == (1, 1)):
+                        lora_name = prefix + "." + name + "." + child_name
+                        lora_name = lora_name.replace(".", "_")
+                        path = ".".join(part for part in (name, child_name) if part)
+                        index.append((lora_name, path))
+        return index
+
+    @staticmethod
+    def module_index(prefix, root_module: torch.nn.Module, target_replace_modules, rescan=False):
+        """
+        find_modules() for a model, looked up by a hash of its config: models with the same architecture share the
+        index, in memory and on disk, so wrapping a model doesn't need a scan of its whole module tree.
+        """
+        config = getattr(root_module, "config", None)
+        if config is None:
+            return LoRANetwork.find_modules(prefix, root_module, target_replace_modules)
+
+        config = config.to_dict() if hasattr(config, "to_dict") else dict(config)
+        config = {k: v for k, v in config.items() if not k.startswith("_")}  # without model paths
+        key = json.dumps(
+            [
+                prefix,
+                root_module.__class__.__name__,
+                target_replace_modules,
+                # module names and layout change between versions of the libraries that define the models
+                [diffusers.__version__, transformers.__version__, torch.__version__],
+                config,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        key = hashlib.sha256(key.encode()).hexdigest()
+
+        path = cache_path("lora_index", f"{key}.json")
+        if not rescan:
+            if key in LoRANetwork.module_indexes:
+                return LoRANetwork.module_indexes[key]
+            index = read_json(path)
+            if index is not None:
+                index = [tuple(entry) for entry in index]
+                LoRANetwork.module_indexes[key] = index
+                return index
+
+        index = LoRANetwork.find_modules(prefix, root_module, target_replace_modules)
+        LoRANetwork.module_indexes[key] = index
+        write_json(path, index)
+        return index
+
     def reset(self):
         for lora in self.text_encoder_loras + self.unet_loras:
+            lora.unmerge()
             lora.enable = False
+        self.loaded_keys = []
+
+    def merge(self):
+        """
+        merge mode: folds every enabled LoRA into the weights of the modules it targets, so that inference runs at the
+        same speed as without LoRA. Original weights are kept on cpu; unmerge() (or reset()) restores them exactly,
+        and must be called before the LoRA or its scale changes.
+        """
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.merge()
 
-    def load(self, file, scale):
+    def unmerge(self):
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.unmerge()
+
+    def set_sample_adapters(self, indices, scales=None):
+        """
+        per-sample mode for batches mixing requests with different LoRAs: indices gives, for every sample of the U-Net
+        batch, the position of its LoRA in the loaded stack or -1 for none, and scales its multiplier (the multiplier
+        that LoRA was loaded with, by default). Merged weights are unmerged, since they would apply to all samples.
+        Passing None for indices goes back to applying the whole stack to every sample.
+        Only the U-Net is per-sample: the text encoder batch is chunk-major and its output is cached by prompt_parser
+        under the whole stack, so the text encoder LoRAs keep applying the whole stack.
+        """
+        if indices is not None:
+            self.unmerge()
+            if scales is None:
+                scales = [self.multipliers[i] if i >= 0 else 0.0 for i in indices]
+
+        for lora in self.unet_loras:
+            lora.set_sample_adapters(indices, scales)
+
+    def is_loaded(self, files):
+        return len(self.loaded_keys) > 0 and self.loaded_keys == [file_key(file) for file in files]
+
+    def set_multipliers(self, scales):
+        """changes the scales of the loaded LoRAs without reloading them; merged weights are merged again"""
+        scales = list(scales)
+        if scales == self.multipliers:
+            return
 
-        weights = None
+        loras = self.text_encoder_loras + self.unet_loras
+        merged = any(lora.merged for lora in loras)
+        self.unmerge()
+        for lora in loras:
+            lora.set_multipliers(scales)
+        self.multipliers = scales
+        if merged:
+            self.merge()
+
+    def read_weights(self, file, dtype=None):
+        """
+        reads a LoRA file, or takes it from the cache of recently used files. Cached weights are kept on cpu, so they
+        don't hold device memory when the network is offloaded; set_weights() copies them into the adapter layers.
+        Returns the state dict, or None if the file is empty.
+        """
+        key = file_key(file)
+        if key in self.weights_cache:
+            self.weights_cache.move_to_end(key)
+            return self.weights_cache[key]
+
+        def convert(key, value):
+            return value.to(dtype=dtype if value.is_floating_point() and "alpha" not in key else None)
+
+        # only tensors of modules that exist in this network are read
+        def is_used(key):
+            return key.split(".", 1)[0] in self.lora_names
+
+        weights = {}
         if os.path.splitext(file)[1] == ".safetensors":
-            weights = load_file(file)
+            # lazily read from the memory mapped file, without materializing the whole file
+            with safe_open(file, framework="pt", device="cpu") as f:
+                for key in f.keys():
+                    if is_used(key):
+                        weights[key] = convert(key, f.get_tensor(key))
         else:
-            weights = torch.load(file, map_location="cpu")
+            state_dict = load_state_dict(file, key_filter=is_used)
+            if state_dict:
+                weights = {k: convert(k, v) for k, v in state_dict.items() if is_used(k)}
 
         if not weights:
+            return None
+        self.weights_cache[key] = weights
+        while len(self.weights_cache) > LoRANetwork.WEIGHTS_CACHE_SIZE:
+            self.weights_cache.popitem(last=False)
+
+        return weights
+
+    def load(self, file, scale, device=None, dtype=None):
+        """loads a single LoRA file with the given scale, see load_multiple()"""
+        self.load_multiple([(file, scale)], device, dtype)
+
+    def load_multiple(self, loras, device=None, dtype=None):
+        """
+        loads a stack of LoRAs, given as a list of (file, scale) pairs, and moves the network to device/dtype.
+        Loading the LoRAs that are already loaded only updates multipliers if scales changed, and does nothing otherwise.
+        """
+        files = [file for file, _ in loras]
+        scales = [scale for _, scale in loras]
+
+        if self.is_loaded(files):
+            if device is not None and self.unet_loras[0].lora_down.weight.device != torch.device(device):
+                self.to(device, dtype=dtype)
+            self.set_multipliers(scales)
             return
 
-        network_alpha = None
-        network_dim = None
-        for key, value in weights.items():
-            if network_alpha is None and "alpha" in key:
-                network_alpha = value
-            if network_dim is None and "lora_down" in key and len(value.size()) == 2:
-                network_dim = value.size()[0]
-
-        if network_alpha is None:
-            network_alpha = network_dim
-
-        weights_has_text_encoder = weights_has_unet = False
-        weights_to_modify = []
+        stack = [(self.read_weights(file, dtype) or {}, scale) for file, scale in loras]
 
-        for key in weights.keys():
-            if key.startswith(LoRANetwork.LORA_PREFIX_TEXT_ENCODER):
-                weights_has_text_encoder = True
-
-            if key.startswith(LoRANetwork.LORA_PREFIX_UNET):
-                weights_has_unet = True
-
-        if weights_has_text_encoder:
-            weights_to_modify += self.text_encoder_loras
-
-        if weights_has_unet:
-            weights_to_modify += self.unet_loras
+        if not any(weights for weights, _ in stack):
+            self.reset()
+            return
 
+        self.unmerge()
+        self.multipliers = [scale for _, scale in stack]
         for lora in self.text_encoder_loras + self.unet_loras:
-            lora.resize(network_dim, network_alpha, scale)
-            if lora in weights_to_modify:
-                lora.enable = True
-
-        info = self.load_state_dict(weights, False)
-        if len(info.unexpected_keys) > 0:
-            print(f"Weights are loaded. Unexpected keys={info.unexpected_keys}")
+            downs, ups, segments = [], [], []
+            for index, (weights, _) in enumerate(stack):
+                down = weights.get(f"{lora.lora_name}.lora_down.weight", None)
+                up = weights.get(f"{lora.lora_name}.lora_up.weight", None)
+                if down is None or up is None:
+                    continue
+
+                rank = down.shape[0]
+                alpha = weights.get(f"{lora.lora_name}.alpha", None)
+                alpha = rank if alpha is None or alpha == 0 else float(alpha)
+                downs.append(down)
+                ups.append(up)
+                segments.append((index, rank, alpha / rank))
+
+            # only modules that have weights in at least one file are enabled
+            lora.set_weights(downs, ups, segments, self.multipliers)
+            lora.enable = len(segments) > 0
+
+        if device is not None:
+            self.to(device, dtype=dtype)
+
+        self.loaded_keys = [file_key(file) for file in files]
@@ -13,11 +13,9 @@ import PIL
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from k_diffusion.external import CompVisDenoiser, CompVisVDenoiser
+from modules.attention import attention, tune
 from modules.prompt_parser import FrozenCLIPEmbedderWithCustomWords
-from torch import einsum
-from torch.autograd.function import Function
 
 from diffusers import DiffusionPipeline
 from diffusers.utils import PIL_INTERPOLATION, is_accelerate_available
@@ -26,17 +24,6 @@ from diffusers.utils import logging, randn_tensor
 import modules.safe as _
 from safetensors.torch import load_file
 
-xformers_available = False
-try:
-    import xformers
-
-    xformers_available = True
-except ImportError:
-    pass
-
-EPSILON = 1e-6
-exists = lambda val: val is not None
-default = lambda val, d: val if exists(val) else d
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 # from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.rescale_noise_cfg
@@ -83,6 +70,43 @@ def get_attention_scores(attn, query, key, attention_mask=None):
     return attention_scores
 
 
+def get_attention_scores_max(attn, query, key, attention_mask=None, chunk_size=1024):
+    """max of get_attention_scores(), computed over chunks of queries without materializing all the scores"""
+    qk_max = None
+    for start in range(0, query.shape[1], chunk_size):
+        chunk_max = get_attention_scores(attn, query[:, start:start + chunk_size], key, attention_mask).amax()
+        qk_max = chunk_max if qk_max is None else torch.maximum(qk_max, chunk_max)
+    return qk_max
+
+
+def get_attention_with_bias(attn, query, key, value, bias, attention_mask=None, chunk_size=1024):
+    """
+    attention with an additive bias of shape (batch, query length, key length), shared by all heads. query, key and
+    value are (batch * heads, length, dim) like head_to_batch_dim returns them. The bias is broadcast over heads: it
+    goes to scaled_dot_product_attention as attn_mask if available, else softmax is computed over chunks of queries.
+    """
+    batch, q_len, k_len = bias.shape
+    heads = query.shape[0] // batch
+    q = query.view(batch, heads, q_len, -1)
+    k = key.view(batch, heads, k_len, -1)
+    v = value.view(batch, heads, k_len, -1)
+
+    if hasattr(F, "scaled_dot_product_attention") and math.isclose(attn.scale, q.shape[-1] ** -0.5):
+        mask = bias.unsqueeze(1)
+        if attention_mask is not None:
+            mask = mask + attention_mask.view(batch, heads, -1, k_len)
+        hidden_states = F.scaled_dot_product_attention(q, k, v, attn_mask=mask.to(q.dtype))
+        return hidden_states.reshape(batch * heads, q_len, -1)
+
+    hidden_states = torch.empty_like(q)
+    for start in range(0, q_len, chunk_size):
+        end = min(start + chunk_size, q_len)
+        scores = get_attention_scores(attn, query[:, start:end], key, attention_mask)
+        scores = scores.view(batch, heads, end - start, k_len) + bias[:, None, start:end]
+        hidden_states[:, :, start:end] = torch.matmul(scores.softmax(dim=-1).to(v.dtype), v)
+    return hidden_states.view(batch * heads, q_len, -1)
+
+
 class CrossAttnProcessor(nn.Module):
     def __call__(
         self,
@@ -104,49 +128,42 @@ class CrossAttnProcessor(nn.Module):
             sigma = encoder_hidden_states["sigma"]
 
         query = attn.to_q(hidden_states)
-        key = attn.to_k(encoder_states)
-        value = attn.to_v(encoder_states)
-
         query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
 
-        if is_xattn and isinstance(img_state, dict):
-            # use torch.baddbmm method (slow)
-            attention_scores = get_attention_scores(attn, query, key, attention_mask)
-            w = img_state[sequence_length].to(query.device)
-            cross_attention_weight = weight_func(w, sigma, attention_scores)
-            attention_scores += torch.repeat_interleave(
-                cross_attention_weight, repeats=attn.heads, dim=0
-            )
-
-            # calc probs
-            attention_probs = attention_scores.softmax(dim=-1)
-            attention_probs = attention_probs.to(query.dtype)
-            hidden_states = torch.bmm(attention_probs, value)
+        # the text conditioning is constant during a request, so are its key/value projections, unless a LoRA on
+        # to_k/to_v changes (LoRAModule bumps lora_version of the modules it wraps)
+        kv_cache = encoder_hidden_states.get("kv_cache", None) if is_xattn else None
+        version = (
+            encoder_states,
+            getattr(attn.to_k, "lora_version", 0),
+            getattr(attn.to_v, "lora_version", 0),
+        )
+        cached = kv_cache.get(id(attn), None) if kv_cache is not None else None
+        if cached is not None and cached[0] is version[0] and cached[1:3] == version[1:]:
+            key, value = cached[3:]
+        else:
+            key = attn.head_to_batch_dim(attn.to_k(encoder_states))
+            value = attn.head_to_batch_dim(attn.to_v(encoder_states))
+            if kv_cache is not None:
+                kv_cache[id(attn)] = (*version, key, value)
 
-        elif xformers_available:
-            hidden_states = xformers.ops.memory_efficient_attention(
-                query.contiguous(),
-                key.contiguous(),
-                value.contiguous(),
-                attn_bias=attention_mask,
+        if is_xattn and isinstance(img_state, dict):
+            # paint with words: the weight is an additive bias of the attention scores
+            w = img_state[sequence_length]  # already on device, see encode_sketchs
+            qk_max = get_attention_scores_max(attn, query, key, attention_mask)
+            cross_attention_weight = weight_func(w, sigma, qk_max)
+            hidden_states = get_attention_with_bias(
+                attn, query, key, value, cross_attention_weight, attention_mask
             )
             hidden_states = hidden_states.to(query.dtype)
 
         else:
-            q_bucket_size = 512
-            k_bucket_size = 1024
-
-            # use flash-attention
-            hidden_states = FlashAttentionFunction.apply(
+            # fastest backend for this shape, see modules/attention.py
+            hidden_states = attention(
                 query.contiguous(),
                 key.contiguous(),
                 value.contiguous(),
                 attention_mask,
-                False,
-                q_bucket_size,
-                k_bucket_size,
             )
             hidden_states = hidden_states.to(query.dtype)
 
@@ -198,6 +215,7 @@ class StableDiffusionPipeline(DiffusionPipeline):
             unet=unet,
             scheduler=scheduler,
         )
+        self.prompt_parsers = {}
         self.setup_unet(self.unet)
         self.setup_text_encoder()
 
@@ -205,8 +223,14 @@ class StableDiffusionPipeline(DiffusionPipeline):
         if new_encoder is not None:
             self.text_encoder = new_encoder
 
-        self.prompt_parser = FrozenCLIPEmbedderWithCustomWords(self.tokenizer, self.text_encoder)
-        self.prompt_parser.CLIP_stop_at_last_layers = n
+        # prompt parsers are reused for every (tokenizer, text encoder, clip skip) combination seen so far
+        key = (id(self.tokenizer), id(self.text_encoder), n)
+        if key not in self.prompt_parsers:
+            prompt_parser = FrozenCLIPEmbedderWithCustomWords(self.tokenizer, self.text_encoder)
+            prompt_parser.CLIP_stop_at_last_layers = n
+            self.prompt_parsers[key] = prompt_parser
+
+        self.prompt_parser = self.prompt_parsers[key]
 
     def setup_unet(self, unet):
         unet = unet.to(self.device)
@@ -216,11 +240,43 @@ class StableDiffusionPipeline(DiffusionPipeline):
         else:
             self.k_diffusion_model = CompVisDenoiser(model)
 
+    def tune_attention(self, resolutions, batch_size=2, text_length=77):
+        """
+        picks the attention backends (see modules/attention.py) for the self and cross-attention layers of the unet at
+        the given (width, height) resolutions, so that requests at these sizes don't wait for tuning.
+        """
+        config = self.unet.config
+        shapes = set()
+        for width, height in resolutions:
+            w, h = width // 8, height // 8
+            for i, channels in enumerate(config.block_out_channels):
+                heads = getattr(config, "num_attention_heads", None) or config.attention_head_dim
+                heads = heads[i] if isinstance(heads, (list, tuple)) else heads
+                has_attention = i == len(config.block_out_channels) - 1 or "CrossAttn" in config.down_block_types[i]
+                if has_attention:
+                    shapes.add((batch_size * heads, w * h, w * h, channels // heads))
+                    shapes.add((batch_size * heads, w * h, text_length, channels // heads))
+                w, h = (w + 1) // 2, (h + 1) // 2
+
+        tune(sorted(shapes), self.unet.dtype, self.unet.device)
+
     def get_scheduler(self, scheduler_type: str):
         library = importlib.import_module("k_diffusion")
         sampling = getattr(library, "sampling")
         return getattr(sampling, scheduler_type)
 
+    def encode_conditioning(self, prompt, negative_prompt):
+        """
+        text conditioning of a request: token ids, embeddings, and a cache of the cross-attention key/value
+        projections of the embeddings, filled by CrossAttnProcessor on the first step and reused afterwards.
+        """
+        text_ids, text_embeddings = self.prompt_parser([negative_prompt, prompt])
+        return {
+            "text_ids": text_ids,
+            "states": text_embeddings.to(self.unet.dtype),
+            "kv_cache": {},
+        }
+
     def encode_sketchs(self, state, scale_ratio=8, g_strength=1.0, text_ids=None):
         uncond, cond = text_ids[0], text_ids[1]
 
@@ -291,7 +347,10 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 if not is_in == 1:
                     print(f"tokens {v_as_tokens} not found in text")
 
-            w_tensors[w_r * h_r] = torch.cat([ret_uncond_tensor, ret_cond_tensor])
+            # staged once per request on the device and in the dtype of the unet, the attention layers use it as is
+            w_tensors[w_r * h_r] = torch.cat([ret_uncond_tensor, ret_cond_tensor]).to(
+                self.unet.device, dtype=self.unet.dtype
+            )
             scale_ratio *= 2
 
         return w_tensors
@@ -464,6 +523,7 @@ class StableDiffusionPipeline(DiffusionPipeline):
         start_time=-1,
         timeout=180,
         scale_ratio=8.0,
+        conditioning=None,
     ):
         sampler = self.get_scheduler(sampler_name)
         if image is not None:
@@ -484,9 +544,10 @@ class StableDiffusionPipeline(DiffusionPipeline):
         if guidance_scale <= 1.0:
             raise ValueError("has to use guidance_scale")
 
-        # 3. Encode input prompt
-        text_ids, text_embeddings = self.prompt_parser([negative_prompt, prompt])
-        text_embeddings = text_embeddings.to(self.unet.dtype)
+        # 3. Encode input prompt, unless the conditioning of a previous pass with the same prompt is given
+        if conditioning is None:
+            conditioning = self.encode_conditioning(prompt, negative_prompt)
+        text_ids, text_embeddings = conditioning["text_ids"], conditioning["states"]
 
         init_timestep = (
             int(num_inference_steps / min(strength, 0.999)) if strength > 0 else 0
@@ -525,12 +586,13 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 assert (time.time() - start_time) < timeout, "inference process timed out"
 
             latent_model_input = torch.cat([x] * 2)
-            weight_func = lambda w, sigma, qk: w * math.log(1 + sigma) * qk.max()
+            weight_func = lambda w, sigma, qk_max: w * math.log(1 + sigma) * qk_max
             encoder_state = {
                 "img_state": img_state,
                 "states": text_embeddings,
-                "sigma": sigma[0],
+                "sigma": sigma[0].item(),  # a float, read once per step rather than in every layer
                 "weight_func": weight_func,
+                "kv_cache": conditioning["kv_cache"],
             }
 
             noise_pred = self.k_diffusion_model(
@@ -657,8 +719,8 @@ class StableDiffusionPipeline(DiffusionPipeline):
             raise ValueError("has to use guidance_scale")
 
         # 3. Encode input prompt
-        text_ids, text_embeddings = self.prompt_parser([negative_prompt, prompt])
-        text_embeddings = text_embeddings.to(self.unet.dtype)
+        conditioning = self.encode_conditioning(prompt, negative_prompt)
+        text_ids, text_embeddings = conditioning["text_ids"], conditioning["states"]
 
         # 4. Prepare timesteps
         sigmas = self.get_sigmas(num_inference_steps, sampler_opt).to(
@@ -695,12 +757,13 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 assert (time.time() - start_time) < timeout, "inference process timed out"
 
             latent_model_input = torch.cat([x] * 2)
-            weight_func = lambda w, sigma, qk: w * math.log(1 + sigma) * qk.max()
+            weight_func = lambda w, sigma, qk_max: w * math.log(1 + sigma) * qk_max
             encoder_state = {
                 "img_state": img_state,
                 "states": text_embeddings,
-                "sigma": sigma[0],
+                "sigma": sigma[0].item(),  # a float, read once per step rather than in every layer
                 "weight_func": weight_func,
+                "kv_cache": conditioning["kv_cache"],
             }
 
             noise_pred = self.k_diffusion_model(
@@ -744,6 +807,7 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 sampler_opt=sampler_opt,
                 pww_state=None,
                 pww_attn_weight=pww_attn_weight / 2,
+                conditioning=conditioning,
             )
 
         # 8. Post-processing
@@ -754,160 +818,3 @@ class StableDiffusionPipeline(DiffusionPipeline):
             image = self.numpy_to_pil(image)
 
         return (image,)
-
-
-class FlashAttentionFunction(Function):
-    @staticmethod
-    @torch.no_grad()
-    def forward(ctx, q, k, v, mask, causal, q_bucket_size, k_bucket_size):
-        """Algorithm 2 in the paper"""
-
-        device = q.device
-        max_neg_value = -torch.finfo(q.dtype).max
-        qk_len_diff = max(k.shape[-2] - q.shape[-2], 0)
-
-        o = torch.zeros_like(q)
-        all_row_sums = torch.zeros((*q.shape[:-1], 1), device=device)
-        all_row_maxes = torch.full((*q.shape[:-1], 1), max_neg_value, device=device)
-
-        scale = q.shape[-1] ** -0.5
-
-        if not exists(mask):
-            mask = (None,) * math.ceil(q.shape[-2] / q_bucket_size)
-        else:
-            mask = rearrange(mask, "b n -> b 1 1 n")
-            mask = mask.split(q_bucket_size, dim=-1)
-
-        row_splits = zip(
-            q.split(q_bucket_size, dim=-2),
-            o.split(q_bucket_size, dim=-2),
-            mask,
-            all_row_sums.split(q_bucket_size, dim=-2),
-            all_row_maxes.split(q_bucket_size, dim=-2),
-        )
-
-        for ind, (qc, oc, row_mask, row_sums, row_maxes) in enumerate(row_splits):
-            q_start_index = ind * q_bucket_size - qk_len_diff
-
-            col_splits = zip(
-                k.split(k_bucket_size, dim=-2),
-                v.split(k_bucket_size, dim=-2),
-            )
-
-            for k_ind, (kc, vc) in enumerate(col_splits):
-                k_start_index = k_ind * k_bucket_size
-
-                attn_weights = einsum("... i d, ... j d -> ... i j", qc, kc) * scale
-
-                if exists(row_mask):
-                    attn_weights.masked_fill_(~row_mask, max_neg_value)
-
-                if causal and q_start_index < (k_start_index + k_bucket_size - 1):
-                    causal_mask = torch.ones(
-                        (qc.shape[-2], kc.shape[-2]), dtype=torch.bool, device=device
-                    ).triu(q_start_index - k_start_index + 1)
-                    attn_weights.masked_fill_(causal_mask, max_neg_value)
-
-                block_row_maxes = attn_weights.amax(dim=-1, keepdims=True)
-                attn_weights -= block_row_maxes
-                exp_weights = torch.exp(attn_weights)
-
-                if exists(row_mask):
-                    exp_weights.masked_fill_(~row_mask, 0.0)
-
-                block_row_sums = exp_weights.sum(dim=-1, keepdims=True).clamp(
-                    min=EPSILON
-                )
-
-                new_row_maxes = torch.maximum(block_row_maxes, row_maxes)
-
-                exp_values = einsum("... i j, ... j d -> ... i d", exp_weights, vc)
-
-                exp_row_max_diff = torch.exp(row_maxes - new_row_maxes)
-                exp_block_row_max_diff = torch.exp(block_row_maxes - new_row_maxes)
-
-                new_row_sums = (
-                    exp_row_max_diff * row_sums
-                    + exp_block_row_max_diff * block_row_sums
-                )
-
-                oc.mul_((row_sums / new_row_sums) * exp_row_max_diff).add_(
-                    (exp_block_row_max_diff / new_row_sums) * exp_values
-                )
-
-                row_maxes.copy_(new_row_maxes)
-                row_sums.copy_(new_row_sums)
-
-        lse = all_row_sums.log() + all_row_maxes
-
-        ctx.args = (causal, scale, mask, q_bucket_size, k_bucket_size)
-        ctx.save_for_backward(q, k, v, o, lse)
-
-        return o
-
-    @staticmethod
-    @torch.no_grad()
-    def backward(ctx, do):
-        """Algorithm 4 in the paper"""
-
-        causal, scale, mask, q_bucket_size, k_bucket_size = ctx.args
-        q, k, v, o, lse = ctx.saved_tensors
-
-        device = q.device
-
-        max_neg_value = -torch.finfo(q.dtype).max
-        qk_len_diff = max(k.shape[-2] - q.shape[-2], 0)
-
-        dq = torch.zeros_like(q)
-        dk = torch.zeros_like(k)
-        dv = torch.zeros_like(v)
-
-        row_splits = zip(
-            q.split(q_bucket_size, dim=-2),
-            o.split(q_bucket_size, dim=-2),
-            do.split(q_bucket_size, dim=-2),
-            mask,
-            lse.split(q_bucket_size, dim=-2),
-            dq.split(q_bucket_size, dim=-2),
-        )
-
-        for ind, (qc, oc, doc, row_mask, lsec, dqc) in enumerate(row_splits):
-            q_start_index = ind * q_bucket_size - qk_len_diff
-
-            col_splits = zip(
-                k.split(k_bucket_size, dim=-2),
-                v.split(k_bucket_size, dim=-2),
-                dk.split(k_bucket_size, dim=-2),
-                dv.split(k_bucket_size, dim=-2),
-            )
-
-            for k_ind, (kc, vc, dkc, dvc) in enumerate(col_splits):
-                k_start_index = k_ind * k_bucket_size
-
-                attn_weights = einsum("... i d, ... j d -> ... i j", qc, kc) * scale
-
-                if causal and q_start_index < (k_start_index + k_bucket_size - 1):
-                    causal_mask = torch.ones(
-                        (qc.shape[-2], kc.shape[-2]), dtype=torch.bool, device=device
-                    ).triu(q_start_index - k_start_index + 1)
-                    attn_weights.masked_fill_(causal_mask, max_neg_value)
-
-                p = torch.exp(attn_weights - lsec)
-
-                if exists(row_mask):
-                    p.masked_fill_(~row_mask, 0.0)
-
-                dv_chunk = einsum("... i j, ... i d -> ... j d", p, doc)
-                dp = einsum("... i d, ... j d -> ... i j", doc, vc)
-
-                D = (doc * oc).sum(dim=-1, keepdims=True)
-                ds = p * scale * (dp - D)
-
-                dq_chunk = einsum("... i j, ... j d -> ... i d", ds, kc)
-                dk_chunk = einsum("... i j, ... i d -> ... j d", ds, qc)
-
-                dqc.add_(dq_chunk)
-                dkc.add_(dk_chunk)
-                dvc.add_(dv_chunk)
-
-        return dq, dk, dv, None, None, None, None
@@ -1,22 +1,76 @@
 import re
 import math
+import time
+from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
 import torch
 
 # Code from https://github.com/AUTOMATIC1111/stable-diffusion-webui/commit/8e2aeee4a127b295bfc880800e4a312e0f049b85, modified.
 
-class PromptChunk:
+class ConditioningCache:
     """
-    This object contains token ids, weight (multipliers:1.4) and textual inversion embedding info for a chunk of prompt.
-    If a prompt is short, it is represented by one PromptChunk, otherwise, multiple are necessary.
-    Each PromptChunk contains an exact amount of tokens - 77, which includes one for start and end token,
-    so just 75 tokens from prompt.
+    A bounded LRU cache of encoded prompts, shared between all prompt parser instances so that it survives
+    the parser being recreated for every request. Entries are keyed on everything that affects the output of
+    the text encoder: chunk tokens, multipliers, the text encoder itself, clip skip and the active LoRA/embedding set.
+    The size of the cache is limited by the total number of bytes held by the cached tensors.
     """
 
-    def __init__(self):
-        self.tokens = []
-        self.multipliers = []
-        self.fixes = []
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+
+    @staticmethod
+    def entry_size(ids, z):
+        return ids.nbytes + z.element_size() * z.nelement()
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        ids, z, elapsed = entry
+        self.saved_time += elapsed
+        return ids, z
+
+    def put(self, key, ids, z, elapsed=0.0):
+        size = self.entry_size(ids, z)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            old_ids, old_z, _ = self.entries.pop(key)
+            self.total_bytes -= self.entry_size(old_ids, old_z)
+
+        self.entries[key] = (ids, z, elapsed)
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes:
+            _, (old_ids, old_z, _) = self.entries.popitem(last=False)
+            self.total_bytes -= self.entry_size(old_ids, old_z)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "saved_time": self.saved_time,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+
+conditioning_cache = ConditioningCache()
 
 
 class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
@@ -33,112 +87,141 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         depending on model."""
 
         self.chunk_length = 75
+        self.CLIP_stop_at_last_layers = 1
+        self.network_key = None
+        """Identifies the set of LoRAs and textual inversion embeddings active for the text encoder; part of the
+        conditioning cache key, since the same tokens encode differently when it changes."""
+
+    def cache_key(self, tokens, multipliers):
+        """returns the conditioning cache key for a batch of chunks, as passed to process_chunks()"""
+
+        return (
+            id(self.text_encoder),
+            self.CLIP_stop_at_last_layers,
+            self.network_key,
+            tokens.shape,
+            tokens.tobytes(),
+            multipliers.tobytes(),
+        )
 
     def empty_chunk(self):
-        """creates an empty PromptChunk and returns it"""
+        """creates token and multiplier arrays for an empty chunk and returns them"""
 
-        chunk = PromptChunk()
-        chunk.tokens = [self.id_start] + [self.id_end] * (self.chunk_length + 1)
-        chunk.multipliers = [1.0] * (self.chunk_length + 2)
-        return chunk
+        tokens = np.full(self.chunk_length + 2, self.id_end, dtype=np.int32)
+        tokens[0] = self.id_start
+        multipliers = np.ones(self.chunk_length + 2, dtype=np.float32)
+        return tokens, multipliers
 
     def get_target_prompt_token_count(self, token_count):
-        """returns the maximum number of tokens a prompt of a known length can have before it requires one more PromptChunk to be represented"""
+        """returns the maximum number of tokens a prompt of a known length can have before it requires one more chunk to be represented"""
 
         return math.ceil(max(token_count, 1) / self.chunk_length) * self.chunk_length
 
-    def tokenize_line(self, line):
+    def chunk_bounds(self, tokens, commas):
         """
-        this transforms a single prompt into a list of PromptChunk objects - as many as needed to
-        represent the prompt.
-        Returns the list and the total number of tokens in the prompt.
+        splits one BREAK-free segment of a prompt into chunks of at most 75 tokens; tokens is the array of tokens
+        of the segment and commas the sorted positions of comma tokens in it.
+        Returns the list of (start, end) positions of every chunk, the last one possibly being empty.
         """
 
-        if self.enable_emphasis:
-            parsed = parse_prompt_attention(line)
-        else:
-            parsed = [[line, 1.0]]
-
-        tokenized = self.tokenize([text for text, _ in parsed])
-
-        chunks = []
-        chunk = PromptChunk()
-        token_count = 0
-        last_comma = -1
-
-        def next_chunk(is_last=False):
-            """puts current chunk into the list of results and produces the next one - empty;
-            if is_last is true, tokens <end-of-text> tokens at the end won't add to token_count"""
-            nonlocal token_count
-            nonlocal last_comma
-            nonlocal chunk
-
-            if is_last:
-                token_count += len(chunk.tokens)
-            else:
-                token_count += self.chunk_length
-
-            to_add = self.chunk_length - len(chunk.tokens)
-            if to_add > 0:
-                chunk.tokens += [self.id_end] * to_add
-                chunk.multipliers += [1.0] * to_add
-
-            chunk.tokens = [self.id_start] + chunk.tokens + [self.id_end]
-            chunk.multipliers = [1.0] + chunk.multipliers + [1.0]
-
-            last_comma = -1
-            chunks.append(chunk)
-            chunk = PromptChunk()
-
         comma_padding_backtrack = 20  # default value in https://github.com/AUTOMATIC1111/stable-diffusion-webui/blob/6cff4401824299a983c8e13424018efc347b4a2b/modules/shared.py#L410
-        for tokens, (text, weight) in zip(tokenized, parsed):
-            if text == "BREAK" and weight == -1:
-                next_chunk()
-                continue
 
-            position = 0
-            while position < len(tokens):
-                token = tokens[position]
+        bounds = []
+        start = 0
+        while start + self.chunk_length < len(tokens):
+            end = start + self.chunk_length
 
-                if token == self.comma_token:
-                    last_comma = len(chunk.tokens)
+            # this is when we are at the end of alloted 75 tokens for the current chunk, and the next token is not a comma. opts.comma_padding_backtrack
+            # is a setting that specifies that if there is a comma nearby, the text after the comma should be moved out of this chunk and into the next.
+            if comma_padding_backtrack != 0 and tokens[end] != self.comma_token:
+                last_comma = np.searchsorted(commas, end) - 1
+                if last_comma >= 0 and commas[last_comma] >= start and end - commas[last_comma] <= comma_padding_backtrack:
+                    end = commas[last_comma] + 1
 
-                # this is when we are at the end of alloted 75 tokens for the current chunk, and the current token is not a comma. opts.comma_padding_backtrack
-                # is a setting that specifies that if there is a comma nearby, the text after the comma should be moved out of this chunk and into the next.
-                elif (
-                    comma_padding_backtrack != 0
-                    and len(chunk.tokens) == self.chunk_length
-                    and last_comma != -1
-                    and len(chunk.tokens) - last_comma <= comma_padding_backtrack
-                ):
-                    break_location = last_comma + 1
+            bounds.append((start, end))
+            start = end
 
-                    reloc_tokens = chunk.tokens[break_location:]
-                    reloc_mults = chunk.multipliers[break_location:]
+        bounds.append((start, len(tokens)))
+        return bounds
 
-                    chunk.tokens = chunk.tokens[:break_location]
-                    chunk.multipliers = chunk.multipliers[:break_location]
-
-                    next_chunk()
-                    chunk.tokens = reloc_tokens
-                    chunk.multipliers = reloc_mults
+    def tokenize_line(self, line):
+        """
+        this transforms a single prompt into as many chunks as needed to represent the prompt. Each chunk contains
+        an exact amount of tokens - 77, which includes one for start and end token, so just 75 tokens from prompt.
+        Returns an int32 array of tokens and a float32 array of multipliers (weights), both of shape (chunks, 77),
+        and the total number of tokens in the prompt.
+        """
 
-                if len(chunk.tokens) == self.chunk_length:
-                    next_chunk()
+        if self.enable_emphasis:
+            parsed = parse_prompt_attention(line)
+        else:
+            parsed = [[line, 1.0]]
 
-                chunk.tokens.append(token)
-                chunk.multipliers.append(weight)
-                position += 1
+        tokenized = self.tokenize([text for text, _ in parsed])
 
-        if len(chunk.tokens) > 0 or len(chunks) == 0:
-            next_chunk(is_last=True)
+        # flatten the prompt into one array of tokens and weights, remembering where BREAK segments end
+        lengths = np.fromiter((len(x) for x in tokenized), dtype=np.int64, count=len(tokenized))
+        is_break = np.fromiter((text == "BREAK" and weight == -1 for text, weight in parsed), dtype=bool, count=len(parsed))
+        lengths[is_break] = 0
+
+        flat_tokens = np.fromiter(
+            (token for tokens, skip in zip(tokenized, is_break) if not skip for token in tokens),
+            dtype=np.int32,
+            count=int(lengths.sum()),
+        )
+        flat_weights = np.repeat(np.fromiter((weight for _, weight in parsed), dtype=np.float64, count=len(parsed)), lengths)
+        segment_ends = np.append(np.cumsum(lengths)[is_break], len(flat_tokens))
+        commas = np.flatnonzero(flat_tokens == self.comma_token)
+
+        starts = []
+        ends = []
+        last_chunk_length = None
+        segment_start = 0
+        for i, segment_end in enumerate(segment_ends):
+            segment_commas = commas[(commas >= segment_start) & (commas < segment_end)] - segment_start
+            bounds = self.chunk_bounds(flat_tokens[segment_start:segment_end], segment_commas)
+
+            # the chunk that is still being filled when a BREAK is found is always kept, even if empty;
+            # at the end of the prompt it is only kept if it has tokens, or if there is no other chunk
+            if i == len(segment_ends) - 1:
+                start, end = bounds[-1]
+                if end > start or (len(starts) == 0 and len(bounds) == 1):
+                    last_chunk_length = end - start
+                else:
+                    bounds.pop()
+
+            starts += [segment_start + start for start, _ in bounds]
+            ends += [segment_start + end for _, end in bounds]
+            segment_start = segment_end
+
+        starts = np.asarray(starts, dtype=np.int64)
+        chunk_lengths = np.asarray(ends, dtype=np.int64) - starts
+        chunk_count = len(starts)
+
+        # all chunks together cover the flattened prompt in order, so every token's place can be computed at once
+        rows = np.repeat(np.arange(chunk_count), chunk_lengths)
+        columns = np.arange(len(rows)) - np.repeat(np.cumsum(chunk_lengths) - chunk_lengths, chunk_lengths) + 1
+        positions = np.repeat(starts, chunk_lengths) + columns - 1
+
+        tokens = np.full((chunk_count, self.chunk_length + 2), self.id_end, dtype=np.int32)
+        tokens[:, 0] = self.id_start
+        tokens[rows, columns] = flat_tokens[positions]
+
+        multipliers = np.ones((chunk_count, self.chunk_length + 2), dtype=np.float32)
+        multipliers[rows, columns] = flat_weights[positions]
+
+        # <end-of-text> tokens at the end of the last chunk of the prompt don't add to token_count
+        if last_chunk_length is not None:
+            token_count = self.chunk_length * (chunk_count - 1) + last_chunk_length
+        else:
+            token_count = self.chunk_length * chunk_count
 
-        return chunks, token_count
+        return tokens, multipliers, token_count
 
     def process_texts(self, texts):
         """
-        Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
-        length, in tokens, of all texts.
+        Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of (tokens, multipliers)
+        results and maximum length, in tokens, of all texts.
         """
 
         token_count = 0
@@ -149,9 +232,10 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
             if line in cache:
                 chunks = cache[line]
             else:
-                chunks, current_token_count = self.tokenize_line(line)
+                tokens, multipliers, current_token_count = self.tokenize_line(line)
                 token_count = max(current_token_count, token_count)
 
+                chunks = (tokens, multipliers)
                 cache[line] = chunks
 
             batch_chunks.append(chunks)
@@ -169,56 +253,108 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         """
 
         batch_chunks, token_count = self.process_texts(texts)
-        chunk_count = max([len(x) for x in batch_chunks])
-
-        zs = []
-        ts = []
-        for i in range(chunk_count):
-            batch_chunk = [
-                chunks[i] if i < len(chunks) else self.empty_chunk()
-                for chunks in batch_chunks
-            ]
-
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
-            # self.embeddings.fixes = [x.fixes for x in batch_chunk]
-
-            # for fixes in self.embeddings.fixes:
-            #     for position, embedding in fixes:
-            #         used_embeddings[embedding.name] = embedding
-
-            z = self.process_tokens(tokens, multipliers)
-            zs.append(z)
-            ts.append(tokens)
-
-        return np.hstack(ts), torch.hstack(zs)
-
-    def process_tokens(self, remade_batch_tokens, batch_multipliers):
+        chunk_count = max([len(tokens) for tokens, _ in batch_chunks])
+
+        # texts with fewer chunks than the longest one are padded with empty chunks
+        empty_tokens, empty_multipliers = self.empty_chunk()
+        tokens = np.tile(empty_tokens, (chunk_count, len(batch_chunks), 1))
+        multipliers = np.tile(empty_multipliers, (chunk_count, len(batch_chunks), 1))
+        for i, (line_tokens, line_multipliers) in enumerate(batch_chunks):
+            tokens[: len(line_tokens), i] = line_tokens
+            multipliers[: len(line_multipliers), i] = line_multipliers
+
+        key = self.cache_key(tokens, multipliers)
+        cached = conditioning_cache.get(key)
+        if cached is not None:
+            ids, z = cached
+            return ids, z.to(self.device(), dtype=self.text_encoder.dtype)
+
+        # kernels run asynchronously on gpu: synchronize so that the time saved by later hits is the real encoder time
+        device = self.device()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        encode_start = time.perf_counter()
+        z = self.process_chunks(tokens, multipliers)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        ids = np.hstack(tokens)
+        conditioning_cache.put(key, ids, z, time.perf_counter() - encode_start)
+        return ids, z
+
+    def process_chunks(self, chunk_tokens, chunk_multipliers):
         """
-        sends one single prompt chunk to be encoded by transformers neural network.
-        remade_batch_tokens is a batch of tokens - a list, where every element is a list of tokens; usually
-        there are exactly 77 tokens in the list. batch_multipliers is the same but for multipliers instead of tokens.
-        Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
-        corresponds to one token.
+        sends every chunk of every text to be encoded by transformers neural network in a single call.
+        chunk_tokens is an int32 array of shape (chunks, B, 77) and chunk_multipliers is the same but for multipliers,
+        as float32. Multipliers are used to give more or less weight to the outputs of transformers network; they and
+        the mean restoration are applied separately for every chunk index. Returns a tensor of shape (B, chunks * 77, C).
         """
-        tokens = torch.asarray(remade_batch_tokens).to(self.device())
+        chunk_count, batch_size = chunk_tokens.shape[:2]
+        remade_batch_tokens = chunk_tokens.reshape(chunk_count * batch_size, -1).astype(np.int64)
 
         # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
         if self.id_end != self.id_pad:
-            for batch_pos in range(len(remade_batch_tokens)):
-                index = remade_batch_tokens[batch_pos].index(self.id_end)
-                tokens[batch_pos, index + 1 : tokens.shape[1]] = self.id_pad
+            index = (remade_batch_tokens == self.id_end).argmax(axis=1)
+            after_end = np.arange(remade_batch_tokens.shape[1]) > index[:, None]
+            remade_batch_tokens[after_end] = self.id_pad
+
+        tokens = torch.from_numpy(remade_batch_tokens).to(self.device())
 
         z = self.encode_with_transformers(tokens)
+        z = z.reshape((chunk_count, batch_size) + z.shape[1:])
 
         # restoring original mean is likely not correct, but it seems to work well to prevent artifacts that happen otherwise
-        batch_multipliers = torch.asarray(batch_multipliers).to(self.device())
-        original_mean = z.mean()
+        batch_multipliers = torch.from_numpy(chunk_multipliers).to(self.device())
+        original_mean = z.mean(dim=(1, 2, 3), keepdim=True)
         z = z * batch_multipliers.reshape(batch_multipliers.shape + (1,)).expand(z.shape)
-        new_mean = z.mean()
+        new_mean = z.mean(dim=(1, 2, 3), keepdim=True)
         z = z * (original_mean / new_mean)
 
-        return z
+        # (chunks, B, 77, C) -> (B, chunks * 77, C), same layout as torch.hstack over chunks
+        return z.transpose(0, 1).reshape(batch_size, chunk_count * z.shape[2], z.shape[3])
+
+
+vocab_tables = {}
+
+
+def get_vocab_tables(tokenizer):
+    """
+    Returns the comma token and the token_mults table (weights of vocabulary entries containing brackets) for a tokenizer.
+    Building them walks the whole vocabulary, so the result is computed once per tokenizer and shared by all prompt
+    parsers using it. Tokens added later (like the emb-... tokens of embeddings) contain neither commas nor brackets,
+    so they can't change the tables.
+    """
+
+    key = id(tokenizer)
+    if key in vocab_tables:
+        return vocab_tables[key]
+
+    vocab = tokenizer.get_vocab()
+
+    comma_token = vocab.get(",</w>", None)
+
+    token_mults = {}
+    tokens_with_parens = [
+        (k, v)
+        for k, v in vocab.items()
+        if "(" in k or ")" in k or "[" in k or "]" in k
+    ]
+    for text, ident in tokens_with_parens:
+        mult = 1.0
+        for c in text:
+            if c == "[":
+                mult /= 1.1
+            if c == "]":
+                mult *= 1.1
+            if c == "(":
+                mult *= 1.1
+            if c == ")":
+                mult /= 1.1
+
+        if mult != 1.0:
+            token_mults[ident] = mult
+
+    vocab_tables[key] = comma_token, token_mults
+    return comma_token, token_mults
 
 
 class FrozenCLIPEmbedderWithCustomWords(FrozenCLIPEmbedderWithCustomWordsBase):
@@ -227,30 +363,7 @@ class FrozenCLIPEmbedderWithCustomWords(FrozenCLIPEmbedderWithCustomWordsBase):
         self.tokenizer = tokenizer
         self.text_encoder = text_encoder
 
-        vocab = self.tokenizer.get_vocab()
-
-        self.comma_token = vocab.get(",</w>", None)
-
-        self.token_mults = {}
-        tokens_with_parens = [
-            (k, v)
-            for k, v in vocab.items()
-            if "(" in k or ")" in k or "[" in k or "]" in k
-        ]
-        for text, ident in tokens_with_parens:
-            mult = 1.0
-            for c in text:
-                if c == "[":
-                    mult /= 1.1
-                if c == "]":
-                    mult *= 1.1
-                if c == "(":
-                    mult *= 1.1
-                if c == ")":
-                    mult /= 1.1
-
-            if mult != 1.0:
-                self.token_mults[ident] = mult
+        self.comma_token, self.token_mults = get_vocab_tables(tokenizer)
 
         self.id_start = self.tokenizer.bos_token_id
         self.id_end = self.tokenizer.eos_token_id
@@ -264,15 +377,17 @@ class FrozenCLIPEmbedderWithCustomWords(FrozenCLIPEmbedderWithCustomWordsBase):
         return tokenized
 
     def encode_with_transformers(self, tokens):
-        CLIP_stop_at_last_layers = 1
         tokens = tokens.to(self.text_encoder.device)
-        outputs = self.text_encoder(tokens, output_hidden_states=True)
 
-        if CLIP_stop_at_last_layers > 1:
-            z = outputs.hidden_states[-CLIP_stop_at_last_layers]
+        # hidden states of every layer are only requested when some are skipped. The shared encoder isn't modified,
+        # since requests may encode concurrently
+        skip = max(self.CLIP_stop_at_last_layers, 1)
+        if skip > 1:
+            outputs = self.text_encoder(tokens, output_hidden_states=True)
+            z = outputs.hidden_states[-skip]
             z = self.text_encoder.text_model.final_layer_norm(z)
         else:
-            z = outputs.last_hidden_state
+            z = self.text_encoder(tokens).last_hidden_state
 
         return z
     
@@ -334,56 +449,91 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
-    res = []
-    round_brackets = []
-    square_brackets = []
+    return [list(x) for x in parse_prompt_attention_cached(text)]
+
+
+@lru_cache(maxsize=1024)
+def parse_prompt_attention_cached(text):
+    """
+    Memoized implementation of parse_prompt_attention(); returns tuples so that cached results can't be modified.
+    The prompt is parsed in two linear passes: the first one pairs up brackets and finds the multiplier of each,
+    the second one walks the text keeping a stack of cumulative weights of open brackets, so that weight of every
+    span is known as soon as it is appended and earlier spans never have to be revisited.
+    """
 
     round_bracket_multiplier = 1.1
     square_bracket_multiplier = 1 / 1.1
 
-    def multiply_range(start_position, multiplier):
-        for p in range(start_position, len(res)):
-            res[p][1] *= multiplier
+    # first pass: ("(", bracket index), (")", bracket index) or (None, text) for every piece of the prompt
+    events = []
+    multipliers = []
+    round_brackets = []
+    square_brackets = []
 
     for m in re_attention.finditer(text):
-        text = m.group(0)
+        piece = m.group(0)
         weight = m.group(1)
 
-        if text.startswith("\\"):
-            res.append([text[1:], 1.0])
-        elif text == "(":
-            round_brackets.append(len(res))
-        elif text == "[":
-            square_brackets.append(len(res))
+        if piece.startswith("\\"):
+            events.append((None, piece[1:]))
+        elif piece == "(":
+            round_brackets.append(len(multipliers))
+            events.append(("(", len(multipliers)))
+            multipliers.append(round_bracket_multiplier)
+        elif piece == "[":
+            square_brackets.append(len(multipliers))
+            events.append(("(", len(multipliers)))
+            multipliers.append(square_bracket_multiplier)
         elif weight is not None and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), float(weight))
-        elif text == ")" and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), round_bracket_multiplier)
-        elif text == "]" and len(square_brackets) > 0:
-            multiply_range(square_brackets.pop(), square_bracket_multiplier)
+            index = round_brackets.pop()
+            multipliers[index] = float(weight)
+            events.append((")", index))
+        elif piece == ")" and len(round_brackets) > 0:
+            events.append((")", round_brackets.pop()))
+        elif piece == "]" and len(square_brackets) > 0:
+            events.append((")", square_brackets.pop()))
         else:
-            parts = re.split(re_break, text)
+            events.append((None, piece))
+
+    # second pass: open_brackets[i] is the index of i-th innermost open bracket, weights[i + 1] is the product of
+    # the multipliers of open_brackets[:i + 1]; unclosed brackets simply stay open until the end of the text
+    res = []
+    open_brackets = []
+    weights = [1.0]
+
+    for kind, value in events:
+        if kind == "(":
+            open_brackets.append(value)
+            weights.append(weights[-1] * multipliers[value])
+        elif kind == ")":
+            if open_brackets[-1] == value:
+                open_brackets.pop()
+                weights.pop()
+            else:
+                # round and square brackets can overlap without nesting: "(a [b) c]"
+                position = open_brackets.index(value)
+                del open_brackets[position]
+                del weights[position + 1 :]
+                for index in open_brackets[position:]:
+                    weights.append(weights[-1] * multipliers[index])
+        elif "BREAK" in value:
+            parts = re.split(re_break, value)
             for i, part in enumerate(parts):
                 if i > 0:
-                    res.append(["BREAK", -1])
-                res.append([part, 1.0])
-
-    for pos in round_brackets:
-        multiply_range(pos, round_bracket_multiplier)
-
-    for pos in square_brackets:
-        multiply_range(pos, square_bracket_multiplier)
+                    res.append(["BREAK", -weights[-1]])
+                res.append([part, weights[-1]])
+        else:
+            res.append([value, weights[-1]])
 
     if len(res) == 0:
         res = [["", 1.0]]
 
     # merge runs of identical weights
-    i = 0
-    while i + 1 < len(res):
-        if res[i][1] == res[i + 1][1]:
-            res[i][0] += res[i + 1][0]
-            res.pop(i + 1)
+    merged = [res[0]]
+    for part, weight in res[1:]:
+        if merged[-1][1] == weight:
+            merged[-1][0] += part
         else:
-            i += 1
+            merged.append([part, weight])
 
-    return res
+    return tuple(tuple(x) for x in merged)
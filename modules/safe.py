@@ -2,6 +2,7 @@
 # modified, from https://github.com/AUTOMATIC1111/stable-diffusion-webui/blob/6cff4401824299a983c8e13424018efc347b4a2b/modules/safe.py
 
 import io
+import os
 import pickle
 import collections
 import sys
@@ -13,9 +14,12 @@ import _codecs
 import zipfile
 import re
 
+from modules.cache import cache_path, file_hash, read_json, write_json
+
 
 # PyTorch 1.13 and later have _TypedStorage renamed to TypedStorage
 TypedStorage = torch.storage.TypedStorage if hasattr(torch.storage, 'TypedStorage') else torch.storage._TypedStorage
+UntypedStorage = torch.UntypedStorage if hasattr(torch, 'UntypedStorage') else torch._UntypedStorage
 
 
 def encode(*args):
@@ -63,6 +67,39 @@ class RestrictedUnpickler(pickle.Unpickler):
         raise Exception(f"global '{module}/{name}' is forbidden")
 
 
+def typed_storage(storage, dtype):
+    try:
+        return TypedStorage(wrap_storage=storage, dtype=dtype, _internal=True)
+    except TypeError:  # before _internal was added
+        return TypedStorage(wrap_storage=storage, dtype=dtype)
+
+
+class StorageUnpickler(RestrictedUnpickler):
+    """
+    RestrictedUnpickler that actually loads the checkpoint: instead of empty storages, persistent_load reads them from
+    the entries of the zip file, so a file is verified and loaded in the same pass.
+    """
+
+    def __init__(self, file, zip_file, prefix, restore_location):
+        super().__init__(file)
+        self.zip_file = zip_file
+        self.prefix = prefix
+        self.restore_location = restore_location
+        self.storages = {}
+
+    def persistent_load(self, saved_id):
+        assert saved_id[0] == 'storage'
+        storage_type, key, location, numel = saved_id[1:]
+        dtype = torch.uint8 if storage_type is UntypedStorage else storage_type.dtype
+
+        if key not in self.storages:
+            data = self.zip_file.read(f"{self.prefix}/data/{key}")
+            storage = UntypedStorage.from_buffer(data, dtype=torch.uint8) if len(data) > 0 else UntypedStorage()
+            self.storages[key] = self.restore_location(storage, location)
+
+        return typed_storage(self.storages[key], dtype)
+
+
 # Regular expression that accepts 'dirname/version', 'dirname/data.pkl', and 'dirname/data/<number>'
 allowed_zip_names_re = re.compile(r"^([^/]+)/((data/\d+)|version|(data\.pkl))$")
 data_pkl_re = re.compile(r"^([^/]+)/data\.pkl$")
@@ -75,20 +112,24 @@ def check_zip_filenames(filename, names):
         raise Exception(f"bad file inside {filename}: {name}")
 
 
+def find_data_pkl(filename, z):
+    check_zip_filenames(filename, z.namelist())
+
+    # find filename of data.pkl in zip file: '<directory name>/data.pkl'
+    data_pkl_filenames = [f for f in z.namelist() if data_pkl_re.match(f)]
+    if len(data_pkl_filenames) == 0:
+        raise Exception(f"data.pkl not found in {filename}")
+    if len(data_pkl_filenames) > 1:
+        raise Exception(f"Multiple data.pkl found in {filename}")
+    return data_pkl_filenames[0]
+
+
 def check_pt(filename, extra_handler):
     try:
 
         # new pytorch format is a zip file
         with zipfile.ZipFile(filename) as z:
-            check_zip_filenames(filename, z.namelist())
-
-            # find filename of data.pkl in zip file: '<directory name>/data.pkl'
-            data_pkl_filenames = [f for f in z.namelist() if data_pkl_re.match(f)]
-            if len(data_pkl_filenames) == 0:
-                raise Exception(f"data.pkl not found in {filename}")
-            if len(data_pkl_filenames) > 1:
-                raise Exception(f"Multiple data.pkl found in {filename}")
-            with z.open(data_pkl_filenames[0]) as file:
+            with z.open(find_data_pkl(filename, z)) as file:
                 unpickler = RestrictedUnpickler(file)
                 unpickler.extra_handler = extra_handler
                 unpickler.load()
@@ -103,6 +144,98 @@ def check_pt(filename, extra_handler):
                 unpickler.load()
 
 
+def restricted_load(filename, extra_handler=None, map_location=None):
+    """
+    loads a checkpoint in the zip format with the allow-list of RestrictedUnpickler, reading the file only once.
+    map_location works like the one of torch.load.
+    """
+
+    with zipfile.ZipFile(filename) as z:
+        data_pkl = find_data_pkl(filename, z)
+        prefix = data_pkl[:-len("/data.pkl")]
+        restore_location = torch.serialization._get_restore_location(map_location)
+        with z.open(data_pkl) as file:
+            unpickler = StorageUnpickler(file, z, prefix, restore_location)
+            unpickler.extra_handler = extra_handler
+            return unpickler.load()
+
+
+verified_index = None  # {"files": {path: [size, mtime, content hash]}, "verified": set of content hashes}
+MAX_VERIFIED_FILES = 1024
+
+
+def get_verified_index(reload=False):
+    """the index of verified files; reload merges in the entries written to disk by other processes since"""
+    global verified_index
+
+    if verified_index is None or reload:
+        index = read_json(cache_path("safe_verified.json"), {})
+        files, verified = index.get("files", {}), set(index.get("verified", []))
+        if verified_index is not None:
+            files.update(verified_index["files"])
+            verified |= verified_index["verified"]
+        verified_index = {"files": files, "verified": verified}
+    return verified_index
+
+
+def save_verified_index():
+    """
+    saves the index, without the files that don't exist anymore (uploads get fresh temporary paths) and keeping at most
+    MAX_VERIFIED_FILES of the most recently added ones, along with the hashes they refer to
+    """
+    index = get_verified_index(reload=True)
+    files = [(path, entry) for path, entry in index["files"].items() if os.path.exists(path)]
+    index["files"] = dict(files[-MAX_VERIFIED_FILES:])
+    index["verified"] &= {entry[2] for entry in index["files"].values()}
+    write_json(cache_path("safe_verified.json"), {"files": index["files"], "verified": sorted(index["verified"])})
+
+
+def cached_content_hash(filename):
+    """content_hash() if it's in the index for the current size and modification time of the file, None otherwise"""
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+
+    def cached_hash(index):
+        entry = index["files"].get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    return cached_hash(get_verified_index()) or cached_hash(get_verified_index(reload=True))
+
+
+def content_hash(filename):
+    """sha256 of the content of a file, only computed again when its size or modification time changed"""
+    h = cached_content_hash(filename)
+    if h is not None:
+        return h
+
+    stat = os.stat(filename)
+    h = file_hash(filename)
+    get_verified_index()["files"][os.path.abspath(filename)] = [stat.st_size, stat.st_mtime_ns, h]
+    save_verified_index()
+    return h
+
+
+def check_pt_cached(filename, extra_handler):
+    """
+    check_pt() that remembers the files that passed it, in a small index on disk. A file is identified by the hash of
+    its content (see content_hash()); a file with the same content as one verified before, at any path, is not checked
+    again. Checks with an extra_handler are never cached.
+    """
+
+    if extra_handler is not None or not isinstance(filename, (str, os.PathLike)):
+        check_pt(filename, extra_handler)
+        return
+
+    h = content_hash(filename)
+    index = get_verified_index()
+    if h not in index["verified"]:
+        check_pt(filename, extra_handler)
+        index["verified"].add(h)
+        save_verified_index()
+
+
 def load(filename, *args, **kwargs):
     return load_with_extra(filename, extra_handler=global_extra_handler, *args, **kwargs)
 
@@ -124,8 +257,24 @@ def load_with_extra(filename, extra_handler=None, *args, **kwargs):
     definitely unsafe.
     """
 
+    # files in the zip format, loaded with no other option than map_location, are verified while they're loaded
+    single_pass = isinstance(filename, (str, os.PathLike)) and len(args) + len(kwargs) <= 1 and \
+        (len(kwargs) == 0 or "map_location" in kwargs) and zipfile.is_zipfile(filename)
+
     try:
-        check_pt(filename, extra_handler)
+        if single_pass:
+            # the content hash is only used when it's already known (e.g. computed by the conversion cache), so that
+            # the file is still read once: content verified before is loaded by torch directly
+            h = cached_content_hash(filename) if extra_handler is None else None
+            index = get_verified_index()
+            if h is None or h not in index["verified"]:
+                state = restricted_load(filename, extra_handler, *args, **kwargs)
+                if h is not None:
+                    index["verified"].add(h)
+                    save_verified_index()
+                return state
+        else:
+            check_pt_cached(filename, extra_handler)
 
     except pickle.UnpicklingError:
         print(f"Error verifying pickled file from {filename}:", file=sys.stderr)